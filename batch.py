@@ -0,0 +1,156 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from models import ModelManager
+from request import IResponder, Request, Response
+from scheduler import Priority
+
+
+class BatchResponder(IResponder):
+    # Collects the final response of one request of a batch
+    def __init__(self, model_manager: ModelManager, client: str, parent=None):
+        super().__init__(model_manager)
+        self.client = client
+        self.priority = Priority.BULK
+        # The responder of the complete_batch request this belongs to
+        self.parent = parent
+        self.final: Response | None = None
+        self.rejected = False
+
+    async def response(self, response: Response):
+        self.final = response
+
+    async def queue_full(self, response: Response):
+        self.rejected = True
+
+
+def prefix_key(request: Request) -> tuple:
+    # Sorted by model and prompt, requests sharing a prefix run next to each
+    # other and reuse what the first one left in the cache
+    params = request.params or {}
+    messages = params.get("messages")
+    prompt = json.dumps(messages) if messages is not None else params.get("prompt")
+    return (str(params.get("model") or ""), str(prompt or ""))
+
+
+async def run(
+    model_manager: ModelManager,
+    requests: list[Request],
+    on_result: Callable[[Request, Response], Awaitable[None]],
+    concurrency: int,
+    client: str = "batch",
+    parent: IResponder | None = None,
+    retry_delay_sec: float = 1,
+) -> dict:
+    # Runs `concurrency` requests at a time, enough to fill the engine's
+    # batch without crowding out other clients' queue. Results are passed
+    # on as they finish, not in input order
+    pending = iter(sorted(requests, key=prefix_key))
+    totals = {"completed": 0, "failed": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    started = time.monotonic()
+
+    async def run_one(request: Request) -> Response:
+        if request.method not in (None, "complete"):
+            return Response.new_error(
+                request.id, "Only complete requests can be batched"  # type: ignore
+            )
+        request.method = "complete"
+        while True:
+            responder = BatchResponder(model_manager, client, parent)
+            await request.handle(model_manager, responder)
+            if not responder.rejected:
+                return responder.final  # type: ignore
+            # Turned away by a full queue, retried once it had time to drain
+            await asyncio.sleep(retry_delay_sec)
+
+    async def worker():
+        for request in pending:
+            if parent is not None and parent.closed:
+                return
+            response = await run_one(request)
+            if response.error is not None:
+                totals["failed"] += 1
+            else:
+                totals["completed"] += 1
+                usage = response.result.get("usage", {})  # type: ignore
+                totals["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                totals["completion_tokens"] += usage.get("completion_tokens", 0)
+            await on_result(request, response)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    elapsed = time.monotonic() - started
+    done = totals["completed"] + totals["failed"]
+    return {
+        **totals,
+        "seconds": elapsed,
+        "prompts_per_sec": done / elapsed if elapsed > 0 else 0.0,
+        "tokens_per_sec": totals["completion_tokens"] / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def load(path: Path) -> list[Request]:
+    # One request per line, shaped like a socket request. Requests without
+    # an id are named after their line
+    requests = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            request = Request(**json.loads(line))
+            if request.id is None:
+                request.id = f"line-{number}"
+            requests.append(request)
+    return requests
+
+
+def finished_ids(path: Path) -> set[str]:
+    # The output doubles as the checkpoint, a line cut short by a crash is
+    # dropped and its request runs again
+    if not path.exists():
+        return set()
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    finished = set()
+    for line in data[:end].splitlines():
+        if line.strip():
+            finished.add(json.loads(line)["id"])
+    return finished
+
+
+async def run_file(
+    model_manager: ModelManager, input: Path, output: Path, concurrency: int
+) -> dict:
+    requests = load(input)
+    finished = finished_ids(output)
+    pending = [request for request in requests if request.id not in finished]
+    if finished:
+        print(
+            f"Resuming batch, {len(finished)} of {len(requests)} requests already done"
+        )
+    with open(output, "a") as f:
+
+        async def write(request: Request, response: Response):
+            f.write(
+                json.dumps(
+                    {
+                        "id": request.id,
+                        "result": response.result,
+                        "error": response.error,
+                    },
+                    sort_keys=True,
+                )
+                + "\n"
+            )
+            f.flush()
+
+        summary = await run(model_manager, pending, write, concurrency)
+    print(
+        f"Batch finished {summary['completed']} requests, {summary['failed']} failed, in {summary['seconds']:.2f}s at {summary['prompts_per_sec']:.2f} prompts/s and {summary['tokens_per_sec']:.2f} tokens/s"
+    )
+    return summary
@@ -0,0 +1,666 @@
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+
+# Replays a JSONL workload of `complete` requests against the websocket, HTTP
+# and RabbitMQ servers and reports throughput and latency percentiles. By
+# default it starts the servers itself with a simulated engine, so it runs on
+# machines without a GPU.
+#
+#   python benchmark.py --transport ws http --concurrency 16
+#   python benchmark.py --rate 20 --requests 500 --save-baseline base.json
+#   python benchmark.py --baseline base.json
+
+ROOT = Path(__file__).parent
+MODEL = "simulated"
+
+
+def parse():
+    parser = argparse.ArgumentParser(
+        description="uLLM-API: Replay a workload against the servers and report latencies."
+    )
+    parser.add_argument(
+        "--workload",
+        type=str,
+        default=str(ROOT / "benchmarks" / "workload.jsonl"),
+        help="A JSONL file of requests, in the same format the servers accept.",
+    )
+    parser.add_argument(
+        "--transport",
+        type=str,
+        nargs="+",
+        choices=["ws", "http", "amqp"],
+        default=["ws", "http"],
+        help="The servers to benchmark, one after the other.",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="The number of requests sent per transport, cycling through the workload.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="The number of connections sending requests at once.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Requests per second, arriving at random (Poisson) intervals. (0 sends the next request as soon as a connection is free)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="The seed for arrival times.",
+    )
+    parser.add_argument(
+        "--spawn",
+        type=bool,
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether to start the servers with a simulated model, otherwise the running ones are used as they are.",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=None,
+        help="A GGUF file or exllamav2 model directory for the spawned server to load instead of the simulated model.",
+    )
+    parser.add_argument(
+        "--server-args",
+        type=str,
+        default="",
+        help="Extra arguments for the spawned server, e.g. \"--threads 8 --gpu-layers 0\".",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="localhost",
+        help="The host the servers run on.",
+    )
+    parser.add_argument("--http-port", type=int, default=18080)
+    parser.add_argument("--sockets-port", type=int, default=18081)
+    parser.add_argument("--rabbitmq-host", type=str, default="localhost")
+    parser.add_argument("--rabbitmq-port", type=int, default=5672)
+    parser.add_argument("--rabbitmq-vhost", type=str, default="/")
+    parser.add_argument("--rabbitmq-queue", type=str, default="ullm.bench")
+    parser.add_argument("--rabbitmq-username", type=str, default="guest")
+    parser.add_argument("--rabbitmq-password", type=str, default="guest")
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=8,
+        help="The maximum number of concurrent completions of the spawned server.",
+    )
+    parser.add_argument(
+        "--prefill-tokens-per-sec",
+        type=float,
+        default=2000,
+        help="The prefill speed of the simulated model.",
+    )
+    parser.add_argument(
+        "--decode-tokens-per-sec",
+        type=float,
+        default=50,
+        help="The decode speed of a single completion of the simulated model.",
+    )
+    parser.add_argument(
+        "--batch-slowdown",
+        type=float,
+        default=0.02,
+        help="How much every decode step of the simulated model slows down per extra running completion.",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        type=str,
+        default=None,
+        help="Write the results to this file to compare later runs against.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="Compare the results against a saved baseline, exits with 1 on regressions.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="How much worse than the baseline a result may be before it counts as a regression.",
+    )
+    parser.add_argument(
+        "--min-change-ms",
+        type=float,
+        default=5,
+        help="Latency changes smaller than this never count as regressions, whatever the tolerance.",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=3,
+        help="How often each transport is benchmarked, the median of every result is reported.",
+    )
+    return parser.parse_args()
+
+
+@dataclass
+class Sample:
+    # Seconds since the request was due to be sent
+    ttft: float | None = None
+    total: float = 0
+    token_gaps: list[float] = field(default_factory=list)
+    chunks: int = 0
+    error: str | None = None
+
+
+def load_workload(path: str) -> list[dict]:
+    with open(path) as f:
+        requests = [json.loads(line) for line in f if line.strip()]
+    return [r for r in requests if r.get("method", "complete") == "complete"]
+
+
+def prepare(request: dict) -> dict:
+    # Fresh ids so replays don't collide, engine_parameters may be inline
+    params = dict(request.get("params", {}))
+    if not isinstance(params.get("engine_parameters", "{}"), str):
+        params["engine_parameters"] = json.dumps(params["engine_parameters"])
+    params.setdefault("engine_parameters", "{}")
+    return {"id": uuid.uuid4().hex, "method": "complete", "params": params}
+
+
+class Timer:
+    def __init__(self, due: float):
+        self.due = due
+        self.last: float | None = None
+        self.sample = Sample()
+
+    def chunk(self) -> None:
+        now = time.monotonic()
+        if self.last is None:
+            self.sample.ttft = now - self.due
+        else:
+            self.sample.token_gaps.append(now - self.last)
+        self.last = now
+        self.sample.chunks += 1
+
+    def finish(self, error: str | None = None) -> Sample:
+        self.sample.total = time.monotonic() - self.due
+        self.sample.error = error
+        return self.sample
+
+
+class WebsocketClient:
+    def __init__(self, args):
+        self.url = f"ws://{args.host}:{args.sockets_port}"
+        self.connection = None
+
+    async def connect(self):
+        from websockets.asyncio.client import connect
+
+        self.connection = await connect(self.url, max_size=None)
+
+    async def close(self):
+        await self.connection.close()  # type: ignore
+
+    async def call(self, request: dict, timer: Timer | None = None) -> dict:
+        await self.connection.send(json.dumps(request))  # type: ignore
+        while True:
+            response = json.loads(await self.connection.recv())  # type: ignore
+            if response.get("id") not in (request["id"], None):
+                continue
+            result = response.get("result") or {}
+            if response.get("error") is None and result.get("status") in (
+                "ongoing",
+                "queued",
+                "loading",
+                "reactivating",
+            ):
+                if timer is not None and result["status"] == "ongoing":
+                    timer.chunk()
+                continue
+            return response
+
+    async def load(self, engine: str, model: str) -> None:
+        response = await self.call(
+            {
+                "id": uuid.uuid4().hex,
+                "method": "load_model",
+                "params": {"engine": engine, "model": model},
+            }
+        )
+        if response.get("error"):
+            raise RuntimeError(response["error"])
+
+    async def complete(self, request: dict, timer: Timer) -> str | None:
+        return (await self.call(request, timer)).get("error")
+
+
+class HttpClient:
+    # Just enough HTTP/1.1 to read server-sent events as they arrive
+    def __init__(self, args):
+        self.host = args.host
+        self.port = args.http_port
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def post(self, path: str, body: dict | None = None):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        payload = json.dumps(body or {}).encode()
+        writer.write(
+            (
+                f"POST {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+            + payload
+        )
+        await writer.drain()
+        headers = {}
+        status = int((await reader.readline()).split()[1])
+        while (line := await reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode().partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return status, headers, reader, writer
+
+    @staticmethod
+    async def lines(reader: asyncio.StreamReader, headers: dict):
+        if headers.get("transfer-encoding") != "chunked":
+            while line := await reader.readline():
+                yield line
+            return
+        buffer = b""
+        while size := int((await reader.readline()).strip() or b"0", 16):
+            buffer += await reader.readexactly(size)
+            await reader.readline()
+            *complete, buffer = buffer.split(b"\n")
+            for line in complete:
+                yield line + b"\n"
+        if buffer:
+            yield buffer
+
+    async def load(self, engine: str, model: str) -> None:
+        status, headers, reader, writer = await self.post(
+            f"/models/{engine.upper().replace('-', '_')}/{model}?wait=true"
+        )
+        body = b"".join([line async for line in self.lines(reader, headers)])
+        writer.close()
+        if status != 200 or json.loads(body).get("error"):
+            raise RuntimeError(body.decode())
+
+    async def complete(self, request: dict, timer: Timer) -> str | None:
+        params = request["params"]
+        body = {
+            **json.loads(params["engine_parameters"]),
+            "prompt": params["prompt"],
+            "stream": True,
+        }
+        if "model" in params:
+            body["model"] = params["model"]
+        status, headers, reader, writer = await self.post("/v1/completions", body)
+        error = None if status == 200 else f"HTTP {status}"
+        try:
+            async for line in self.lines(reader, headers):
+                if not line.startswith(b"data: ") or line.strip() == b"data: [DONE]":
+                    continue
+                event = json.loads(line[6:])
+                if "error" in event:
+                    error = str(event["error"])
+                elif event["choices"][0].get("text"):
+                    timer.chunk()
+        finally:
+            writer.close()
+        return error
+
+
+class RabbitMQClient:
+    # pika's blocking client on a thread per connection, replies are
+    # timestamped as they arrive
+    def __init__(self, args):
+        self.args = args
+
+    async def connect(self):
+        import pika
+
+        args = self.args
+        self.connection = await asyncio.to_thread(
+            pika.BlockingConnection,
+            pika.ConnectionParameters(
+                args.rabbitmq_host,
+                args.rabbitmq_port,
+                args.rabbitmq_vhost,
+                pika.PlainCredentials(args.rabbitmq_username, args.rabbitmq_password),
+            ),
+        )
+        self.channel = self.connection.channel()
+        self.reply_queue = self.channel.queue_declare("", exclusive=True).method.queue
+
+    async def close(self):
+        await asyncio.to_thread(self.connection.close)
+
+    def call_blocking(self, request: dict, timer: Timer | None) -> dict:
+        import pika
+
+        self.channel.basic_publish(
+            exchange="",
+            routing_key=self.args.rabbitmq_queue,
+            body=json.dumps(request),
+            properties=pika.BasicProperties(
+                reply_to=self.reply_queue, correlation_id=request["id"]
+            ),
+        )
+        for _, properties, body in self.channel.consume(
+            self.reply_queue, auto_ack=True, inactivity_timeout=600
+        ):
+            if body is None:
+                raise TimeoutError("No reply from rabbitmq")
+            if properties.correlation_id != request["id"]:
+                continue
+            response = json.loads(body)
+            result = response.get("result") or {}
+            if response.get("error") is None and result.get("status") in (
+                "ongoing",
+                "queued",
+                "loading",
+                "reactivating",
+            ):
+                if timer is not None and result["status"] == "ongoing":
+                    timer.chunk()
+                continue
+            self.channel.cancel()
+            return response
+        raise RuntimeError("Rabbitmq consumer stopped")
+
+    async def load(self, engine: str, model: str) -> None:
+        request = {
+            "id": uuid.uuid4().hex,
+            "method": "load_model",
+            "params": {"engine": engine, "model": model},
+        }
+        response = await asyncio.to_thread(self.call_blocking, request, None)
+        if response.get("error"):
+            raise RuntimeError(response["error"])
+
+    async def complete(self, request: dict, timer: Timer) -> str | None:
+        response = await asyncio.to_thread(self.call_blocking, request, timer)
+        return response.get("error")
+
+
+CLIENTS = {"ws": WebsocketClient, "http": HttpClient, "amqp": RabbitMQClient}
+
+
+async def replay(args, transport: str, workload: list[dict]) -> tuple[list[Sample], float]:
+    clients = [CLIENTS[transport](args) for _ in range(args.concurrency)]
+    await asyncio.gather(*(client.connect() for client in clients))
+    idle: asyncio.Queue = asyncio.Queue()
+    for client in clients:
+        idle.put_nowait(client)
+    requests = itertools.islice(itertools.cycle(workload), args.requests)
+    samples: list[Sample] = []
+    arrivals = random.Random(args.seed)
+
+    async def send(request: dict, due: float, client=None):
+        if client is None:
+            client = await idle.get()
+        timer = Timer(due)
+        try:
+            error = await client.complete(prepare(request), timer)
+        except Exception as e:
+            error = str(e)
+        finally:
+            idle.put_nowait(client)
+        samples.append(timer.finish(error))
+
+    started = time.monotonic()
+    tasks = []
+    due = started
+    for request in requests:
+        if args.rate > 0:
+            # Open loop, latency counts from when the request was due so a
+            # backed up server can't hide its queueing
+            due += arrivals.expovariate(args.rate)
+            await asyncio.sleep(max(0, due - time.monotonic()))
+            tasks.append(asyncio.create_task(send(request, due)))
+        else:
+            client = await idle.get()
+            tasks.append(asyncio.create_task(send(request, time.monotonic(), client)))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+    await asyncio.gather(*(client.close() for client in clients))
+    return samples, elapsed
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "max": values[-1],
+        "mean": sum(values) / len(values),
+    }
+
+
+def summarize(samples: list[Sample], elapsed: float) -> dict:
+    ok = [s for s in samples if s.error is None]
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "elapsed_sec": elapsed,
+        "requests_per_sec": len(ok) / elapsed,
+        "chunks_per_sec": sum(s.chunks for s in ok) / elapsed,
+        "ttft": percentiles([s.ttft for s in ok if s.ttft is not None]),
+        "token": percentiles([gap for s in ok for gap in s.token_gaps]),
+        "total": percentiles([s.total for s in ok]),
+    }
+
+
+def median_summary(summaries: list[dict]) -> dict:
+    # Takes the median of every number across runs, so one noisy run can't
+    # decide a comparison
+    def median(values: list):
+        if isinstance(values[0], dict):
+            keys = set.intersection(*(set(value) for value in values))
+            return {key: median([value[key] for value in values]) for key in keys}
+        values = sorted(values)
+        return values[len(values) // 2]
+
+    summary = median(summaries)
+    for name in ("ttft", "token", "total"):
+        summary[name] = {
+            key: summary[name][key]
+            for key in ("p50", "p90", "p99", "max", "mean")
+            if key in summary[name]
+        }
+    return summary
+
+
+def report(transport: str, summary: dict) -> None:
+    print(
+        f"\n{transport}: {summary['requests']} requests, {summary['errors']} errors in "
+        f"{summary['elapsed_sec']:.2f}s, {summary['requests_per_sec']:.2f} req/s, "
+        f"{summary['chunks_per_sec']:.1f} chunks/s"
+    )
+    for name in ("ttft", "token", "total"):
+        stats = summary[name]
+        if stats:
+            print(
+                f"  {name:<6}"
+                + "".join(f"  {key} {value * 1000:9.1f}ms" for key, value in stats.items())
+            )
+
+
+def compare(
+    results: dict, baseline: dict, tolerance: float, min_change_ms: float
+) -> list[str]:
+    regressions = []
+    for transport, summary in results.items():
+        before = baseline.get(transport)
+        if before is None:
+            continue
+        checks = [("requests_per_sec", summary["requests_per_sec"], before["requests_per_sec"], False)]
+        for name in ("ttft", "token", "total"):
+            for key in ("p50", "p99"):
+                if key in summary[name] and key in before[name]:
+                    checks.append((f"{name} {key}", summary[name][key], before[name][key], True))
+        for name, now, then, lower_is_better in checks:
+            if then == 0:
+                continue
+            change = (now - then) / then
+            if lower_is_better:
+                # Millisecond latencies jitter by more than any sane tolerance
+                worse = change > tolerance and (now - then) * 1000 > min_change_ms
+            else:
+                worse = change < -tolerance
+            print(f"  {transport} {name}: {then:.4f} -> {now:.4f} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+            if worse:
+                regressions.append(f"{transport} {name}")
+    return regressions
+
+
+def wait_for_port(host: str, port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def served_model(args) -> tuple[str, str]:
+    if args.model is None:
+        return "simulated", MODEL
+    path = Path(args.model)
+    return ("llama-cpp" if path.is_file() else "exllamav2"), path.name
+
+
+def spawn(args, data_dir: Path) -> subprocess.Popen:
+    if args.model is not None:
+        (data_dir / "models").mkdir(parents=True)
+        (data_dir / "models" / Path(args.model).name).symlink_to(
+            Path(args.model).resolve()
+        )
+    else:
+        model_dir = data_dir / "models" / MODEL
+        model_dir.mkdir(parents=True)
+        (model_dir / "simulated.json").write_text(
+            json.dumps(
+                {
+                    "prefill_tokens_per_sec": args.prefill_tokens_per_sec,
+                    "decode_tokens_per_sec": args.decode_tokens_per_sec,
+                    "batch_slowdown": args.batch_slowdown,
+                }
+            )
+        )
+    command = [
+        sys.executable,
+        str(ROOT / "main.py"),
+        "--data-dir", str(data_dir),
+        "--host", args.host,
+        "--max-batch-size", str(args.max_batch_size),
+        "--max-queued", str(max(64, args.requests)),
+        "--no-embed",
+    ]
+    if "ws" in args.transport:
+        command += ["--sockets", "--sockets-port", str(args.sockets_port)]
+    if "http" in args.transport:
+        command += ["--http", "--http-port", str(args.http_port)]
+    if "amqp" in args.transport:
+        command += [
+            "--rabbitmq",
+            "--rabbitmq-host", args.rabbitmq_host,
+            "--rabbitmq-port", str(args.rabbitmq_port),
+            "--rabbitmq-vhost", args.rabbitmq_vhost,
+            "--rabbitmq-queue", args.rabbitmq_queue,
+            "--rabbitmq-username", args.rabbitmq_username,
+            "--rabbitmq-password", args.rabbitmq_password,
+            "--rabbitmq-prefetch", str(args.concurrency),
+        ]
+    command += shlex.split(args.server_args)
+    server = subprocess.Popen(command, cwd=ROOT)
+    if "ws" in args.transport:
+        wait_for_port(args.host, args.sockets_port)
+    if "http" in args.transport:
+        wait_for_port(args.host, args.http_port)
+    return server
+
+
+async def bench(args) -> int:
+    workload = load_workload(args.workload)
+    if not workload:
+        print(f"No complete requests in {args.workload}")
+        return 1
+    if args.spawn:
+        # Any transport can load the model, the first one does it
+        loader = CLIENTS[args.transport[0]](args)
+        await loader.connect()
+        await loader.load(*served_model(args))
+        await loader.close()
+    results = {}
+    for transport in args.transport:
+        summaries = []
+        for _ in range(args.runs):
+            samples, elapsed = await replay(args, transport, workload)
+            summaries.append(summarize(samples, elapsed))
+        results[transport] = median_summary(summaries)
+        report(transport, results[transport])
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(results, indent=4))
+        print(f"\nSaved baseline to {args.save_baseline}")
+    if args.baseline:
+        print(f"\nCompared to {args.baseline}:")
+        regressions = compare(
+            results,
+            json.loads(Path(args.baseline).read_text()),
+            args.tolerance,
+            args.min_change_ms,
+        )
+        if regressions:
+            print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+def main():
+    args = parse()
+    server = None
+    data_dir = Path(tempfile.mkdtemp(prefix="ullm-bench-"))
+    try:
+        if args.spawn:
+            server = spawn(args, data_dir)
+        code = asyncio.run(bench(args))
+    finally:
+        if server is not None:
+            server.kill()
+            server.wait()
+        shutil.rmtree(data_dir, ignore_errors=True)
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
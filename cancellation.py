@@ -0,0 +1,39 @@
+import threading
+
+from engines.engine import CancellationToken
+
+
+class CancellationRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # token -> (request id, client, owner)
+        self.tokens: dict[CancellationToken, tuple[str, str, object]] = {}
+
+    def register(self, request_id: str, client: str, owner: object) -> CancellationToken:
+        token = CancellationToken()
+        with self.lock:
+            self.tokens[token] = (request_id, client, owner)
+        return token
+
+    def unregister(self, token: CancellationToken) -> None:
+        with self.lock:
+            self.tokens.pop(token, None)
+
+    def cancel(self, request_id: str, client: str) -> int:
+        # Request ids are chosen by clients, so they're only unique per client
+        return self.cancel_where(
+            lambda entry: entry[0] == request_id and entry[1] == client
+        )
+
+    def cancel_client(self, client: str) -> int:
+        return self.cancel_where(lambda entry: entry[1] == client)
+
+    def cancel_owner(self, owner: object) -> int:
+        return self.cancel_where(lambda entry: entry[2] is owner)
+
+    def cancel_where(self, predicate) -> int:
+        with self.lock:
+            tokens = [token for token, entry in self.tokens.items() if predicate(entry)]
+        for token in tokens:
+            token.cancel()
+        return len(tokens)
@@ -37,6 +37,12 @@ def parse():
         default=8081,
         help="The port to run the websocket server on.",
     )
+    parser.add_argument(
+        "--sockets-max-in-flight",
+        type=int,
+        default=64,
+        help="The number of requests a websocket connection may have running before the server stops reading from it.",
+    )
     parser.add_argument(
         "--rabbitmq",
         type=bool,
@@ -86,10 +92,202 @@ def parse():
         default="guest",
         help="The password for rabbitmq.",
     )
+    parser.add_argument(
+        "--rabbitmq-prefetch",
+        type=int,
+        default=16,
+        help="The number of rabbitmq messages handled concurrently.",
+    )
+    parser.add_argument(
+        "--rabbitmq-heartbeat-sec",
+        type=int,
+        default=60,
+        help="The heartbeat interval negotiated with rabbitmq.",
+    )
+    parser.add_argument(
+        "--rabbitmq-flush-ms",
+        type=float,
+        default=50,
+        help="How long streamed tokens are batched before they're published to rabbitmq, unless a request sets flush_ms. (0 publishes every token)",
+    )
+    parser.add_argument(
+        "--rabbitmq-max-unconfirmed",
+        type=int,
+        default=1024,
+        help="The number of published replies rabbitmq may leave unconfirmed before publishing waits.",
+    )
     parser.add_argument(
         "--data-dir",
         type=str,
         default="$XDG_DATA_HOME/ullm-api",
         help="The directory to store the data and models in.",
     )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=8,
+        help="The maximum number of completions generated concurrently per model.",
+    )
+    parser.add_argument(
+        "--cache-tokens",
+        type=int,
+        default=8192,
+        help="The number of tokens of KV cache shared by all concurrent completions. (exllamav2 also keeps reusable prompt prefixes in it)",
+    )
+    parser.add_argument(
+        "--prefix-cache-mb",
+        type=int,
+        default=2048,
+        help="The memory budget for saved prompt prefix states. (llama-cpp)",
+    )
+    parser.add_argument(
+        "--context-window",
+        type=int,
+        default=4096,
+        help="The context size models are loaded with, unless a load_model request sets context_window. (llama-cpp)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="The number of threads used for generation, defaults to the number of cores. (llama-cpp)",
+    )
+    parser.add_argument(
+        "--threads-batch",
+        type=int,
+        default=None,
+        help="The number of threads used for prompt processing, defaults to --threads. (llama-cpp)",
+    )
+    parser.add_argument(
+        "--batch-tokens",
+        type=int,
+        default=512,
+        help="The number of prompt tokens processed per batch. (llama-cpp)",
+    )
+    parser.add_argument(
+        "--gpu-layers",
+        type=int,
+        default=-1,
+        help="The number of layers offloaded to the GPU, 0 runs on the CPU only. (-1 offloads all, llama-cpp)",
+    )
+    parser.add_argument(
+        "--mmap",
+        type=bool,
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether to memory-map model files instead of reading them into memory. (llama-cpp)",
+    )
+    parser.add_argument(
+        "--mlock",
+        type=bool,
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Whether to lock the model in RAM so it's never swapped out. (llama-cpp)",
+    )
+    parser.add_argument(
+        "--draft-model",
+        type=str,
+        default=None,
+        help="A smaller model from the models directory, sharing the tokenizer, that speculates tokens for every loaded model. A load_model request can set its own draft_model.",
+    )
+    parser.add_argument(
+        "--draft-tokens",
+        type=int,
+        default=4,
+        help="The number of tokens speculated per step by the draft model or n-gram lookup.",
+    )
+    parser.add_argument(
+        "--ngram-draft",
+        type=bool,
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Whether to speculate tokens by looking up n-grams of the prompt when there's no draft model.",
+    )
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=64,
+        help="The maximum number of completions waiting for a free slot before new ones are rejected.",
+    )
+    parser.add_argument(
+        "--memory-budget-mb",
+        type=int,
+        default=0,
+        help="The memory models may occupy together before the least recently used one is unloaded. (0 keeps a single model loaded)",
+    )
+    parser.add_argument(
+        "--parked-timeout-sec",
+        type=int,
+        default=1800,
+        help="How long an idle model stays parked, with its weights kept in the page cache, before it's fully released. (0 releases it right away)",
+    )
+    parser.add_argument(
+        "--session-memory-mb",
+        type=int,
+        default=2048,
+        help="The memory KV snapshots of sessions may use before idle ones are written to the data directory.",
+    )
+    parser.add_argument(
+        "--unload-first",
+        type=bool,
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Whether to unload the current model before loading a new one, for GPUs that can't hold both. (requests fail while the new one loads)",
+    )
+    parser.add_argument(
+        "--embed",
+        type=bool,
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether to serve embeddings on the http server.",
+    )
+    parser.add_argument(
+        "--embed-preload",
+        type=bool,
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Whether to load the embedding model in the background at startup instead of on first use.",
+    )
+    parser.add_argument(
+        "--embed-batch-size",
+        type=int,
+        default=64,
+        help="The maximum number of texts embedded in one batch.",
+    )
+    parser.add_argument(
+        "--embed-batch-wait-ms",
+        type=float,
+        default=5,
+        help="How long to wait for concurrent embed requests to fill a batch.",
+    )
+    parser.add_argument(
+        "--embed-cache-items",
+        type=int,
+        default=10000,
+        help="The number of embeddings kept in memory, the rest are read from the data directory.",
+    )
+    parser.add_argument(
+        "--batch-input",
+        type=str,
+        default=None,
+        help="Runs the complete requests of this JSONL file, one request per line, instead of starting servers.",
+    )
+    parser.add_argument(
+        "--batch-output",
+        type=str,
+        default=None,
+        help="The JSONL file results are appended to as they finish, a rerun skips requests already in it. (defaults to the input with .out.jsonl)",
+    )
+    parser.add_argument(
+        "--batch-model",
+        type=str,
+        default=None,
+        help="The model from the models directory to load for the batch.",
+    )
+    parser.add_argument(
+        "--batch-concurrency",
+        type=int,
+        default=0,
+        help="The number of batch requests running at once. (0 for the max batch size)",
+    )
     return parser.parse_args()
@@ -0,0 +1,61 @@
+import asyncio
+from typing import Awaitable, Callable
+
+
+# Buffers streamed chunks and emits them together once `flush_tokens` chunks
+# have arrived or `flush_ms` has passed since the first buffered one. With
+# neither set every chunk is emitted as soon as it arrives.
+class Coalescer:
+    def __init__(
+        self,
+        emit: Callable[[str], Awaitable[None]],
+        flush_ms: float | None = None,
+        flush_tokens: int | None = None,
+    ):
+        self.emit = emit
+        self.flush_ms = flush_ms
+        self.flush_tokens = flush_tokens
+        self.buffer: list[str] = []
+        self.timer: asyncio.Task | None = None
+        self.lock = asyncio.Lock()
+        # A failed timed flush is raised from the next push or close
+        self.error: Exception | None = None
+
+    async def push(self, chunk: str) -> None:
+        self.raise_error()
+        if not self.flush_ms and not self.flush_tokens:
+            await self.emit(chunk)
+            return
+        self.buffer.append(chunk)
+        if self.flush_tokens and len(self.buffer) >= self.flush_tokens:
+            await self.flush()
+        elif self.flush_ms and self.timer is None:
+            self.timer = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self) -> None:
+        await asyncio.sleep(self.flush_ms / 1000)  # type: ignore
+        self.timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            self.error = e
+
+    def raise_error(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    async def flush(self) -> None:
+        if self.timer is not None and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+            self.timer = None
+        async with self.lock:
+            if not self.buffer:
+                return
+            chunk = "".join(self.buffer)
+            self.buffer.clear()
+            await self.emit(chunk)
+
+    async def close(self) -> None:
+        self.raise_error()
+        await self.flush()
@@ -20,3 +20,18 @@ class DataDir:
         if not os.path.exists(os.path.join(self.data_dir, "models")):
             os.makedirs(os.path.join(self.data_dir, "models"))
         return Path(os.path.join(self.data_dir, "models"))
+
+    def get_embed_cache_path(self) -> Path:
+        if not os.path.exists(os.path.join(self.data_dir, "embeddings")):
+            os.makedirs(os.path.join(self.data_dir, "embeddings"))
+        return Path(os.path.join(self.data_dir, "embeddings"))
+
+    def get_session_path(self) -> Path:
+        if not os.path.exists(os.path.join(self.data_dir, "sessions")):
+            os.makedirs(os.path.join(self.data_dir, "sessions"))
+        return Path(os.path.join(self.data_dir, "sessions"))
+
+    def get_preset_path(self) -> Path:
+        if not os.path.exists(os.path.join(self.data_dir, "presets")):
+            os.makedirs(os.path.join(self.data_dir, "presets"))
+        return Path(os.path.join(self.data_dir, "presets"))
@@ -1,9 +1,88 @@
-from sentence_transformers import SentenceTransformer
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from embed_cache import EmbeddingCache
+import metrics
 from typing import List
 
+MODEL_NAME = "nomic-ai/nomic-embed-text-v1"
+
+
 class EmbedManager:
-    def __init__(self):
-        self.model = SentenceTransformer("nomic-ai/nomic-embed-text-v1", trust_remote_code=True)
+    def __init__(
+        self,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5,
+        cache: EmbeddingCache | None = None,
+        preload: bool = False,
+    ):
+        self.model = None
+        self.model_lock = threading.Lock()
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue: queue.Queue[tuple[str, Future]] = queue.Queue()
+        self.thread = threading.Thread(target=self.batch_loop, daemon=True)
+        self.thread.start()
+        if preload:
+            threading.Thread(target=self.load_model, daemon=True).start()
+
+    def load_model(self):
+        with self.model_lock:
+            if self.model is None:
+                from sentence_transformers import SentenceTransformer
+
+                print(f"Loading embedding model {MODEL_NAME}")
+                self.model = SentenceTransformer(MODEL_NAME, trust_remote_code=True)
+        return self.model
 
     def embed(self, text: str) -> List[float]:
-        return self.model.encode([text]).flatten().tolist()
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        futures = []
+        for text in texts:
+            future = Future()
+            embedding = self.cache.get(text) if self.cache is not None else None
+            if embedding is not None:
+                future.set_result(embedding)
+            else:
+                self.queue.put((text, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def status(self) -> dict:
+        return {
+            "model": MODEL_NAME,
+            "loaded": self.model is not None,
+            "cache": self.cache.status() if self.cache is not None else None,
+        }
+
+    def batch_loop(self):
+        # Gathers concurrent requests for up to `max_wait_ms` or until the
+        # batch is full, then encodes them in a single forward pass
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        batch.append(self.queue.get(timeout=timeout))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            metrics.EMBED_BATCH_SIZE.observe(len(batch))
+            try:
+                embeddings = self.load_model().encode([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (text, future), embedding in zip(batch, embeddings):
+                embedding = embedding.tolist()
+                if self.cache is not None:
+                    self.cache.put(text, embedding)
+                future.set_result(embedding)
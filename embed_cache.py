@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+KEY_SIZE = hashlib.sha256().digest_size
+
+
+# Content-addressed embedding store. Keys are sha256(model, text), recent
+# vectors are kept in an in-memory LRU and every vector is appended to a
+# float32 file that is memory-mapped for reads, so hits survive restarts.
+#
+# On disk: `vectors.f32` holds one row of `dim` float32s per entry and
+# `keys.bin` the matching 32 byte keys in the same order. Vectors are written
+# before their key, so a torn write is dropped when the store is reopened.
+class EmbeddingCache:
+    def __init__(self, path: Path, model_name: str, memory_items: int = 10000):
+        self.path = path
+        self.model_name = model_name
+        self.memory_items = memory_items
+        self.memory: OrderedDict[bytes, List[float]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.vectors_path = path / "vectors.f32"
+        self.keys_path = path / "keys.bin"
+        self.meta_path = path / "meta.json"
+        self.dim: int | None = None
+        if self.meta_path.exists():
+            self.dim = json.loads(self.meta_path.read_text())["dim"]
+        self.rows: dict[bytes, int] = {}
+        self.mapped: np.memmap | None = None
+        self.load_index()
+
+    def load_index(self) -> None:
+        if (
+            self.dim is None
+            or not self.keys_path.exists()
+            or not self.vectors_path.exists()
+        ):
+            return
+        keys = self.keys_path.read_bytes()
+        vector_rows = os.path.getsize(self.vectors_path) // (self.dim * 4)
+        count = min(len(keys) // KEY_SIZE, vector_rows)
+        for row in range(count):
+            self.rows[keys[row * KEY_SIZE : (row + 1) * KEY_SIZE]] = row
+        # Drop anything past the last complete entry
+        with open(self.keys_path, "r+b") as f:
+            f.truncate(count * KEY_SIZE)
+        with open(self.vectors_path, "r+b") as f:
+            f.truncate(count * self.dim * 4)
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(
+            self.model_name.encode() + b"\0" + text.encode()
+        ).digest()
+
+    def get(self, text: str) -> List[float] | None:
+        key = self.key(text)
+        with self.lock:
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+            row = self.rows.get(key)
+            if row is None:
+                self.misses += 1
+                return None
+            embedding = self.read_row(row)
+            self.disk_hits += 1
+            self.remember(key, embedding)
+            return embedding
+
+    def put(self, text: str, embedding: List[float]) -> None:
+        key = self.key(text)
+        with self.lock:
+            self.remember(key, embedding)
+            if key in self.rows:
+                return
+            if self.dim is None:
+                self.dim = len(embedding)
+                self.meta_path.write_text(json.dumps({"dim": self.dim}))
+            if len(embedding) != self.dim:
+                return
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.asarray(embedding, dtype=np.float32).tobytes())
+            with open(self.keys_path, "ab") as f:
+                f.write(key)
+            self.rows[key] = len(self.rows)
+
+    def read_row(self, row: int) -> List[float]:
+        if self.mapped is None or row >= self.mapped.shape[0]:
+            self.mapped = np.memmap(
+                self.vectors_path, dtype=np.float32, mode="r"
+            ).reshape(-1, self.dim)
+        return self.mapped[row].tolist()
+
+    def remember(self, key: bytes, embedding: List[float]) -> None:
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def status(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "disk_entries": len(self.rows),
+            }
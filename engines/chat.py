@@ -0,0 +1,42 @@
+import json
+from pathlib import Path
+from typing import List, Optional
+
+
+def load_chat_template(path: Path) -> Optional[str]:
+    # Chat templates ship in the tokenizer config of HF style model folders
+    config = Path(path) / "tokenizer_config.json"
+    if not config.is_file():
+        return None
+    template = json.loads(config.read_text()).get("chat_template")
+    if isinstance(template, list):
+        template = next(
+            (t["template"] for t in template if t.get("name") == "default"), None
+        )
+    return template
+
+
+def render_chat(messages: List[dict], template: Optional[str] = None) -> str:
+    if template is not None:
+        try:
+            from jinja2.sandbox import ImmutableSandboxedEnvironment
+        except ImportError:
+            pass
+        else:
+            def raise_exception(message):
+                raise ValueError(message)
+
+            env = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True)
+            env.globals["raise_exception"] = raise_exception
+            # Engines add the BOS token themselves when encoding the prompt
+            return env.from_string(template).render(
+                messages=messages,
+                add_generation_prompt=True,
+                bos_token="",
+                eos_token="",
+            )
+    # ChatML when the model doesn't come with a template
+    prompt = ""
+    for message in messages:
+        prompt += f"<|im_start|>{message['role']}\n{message['content']}<|im_end|>\n"
+    return prompt + "<|im_start|>assistant\n"
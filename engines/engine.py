@@ -1,14 +1,21 @@
 from enum import Enum
 import json
 import asyncio
-from typing import Awaitable, Callable, List, Tuple, Optional
+import threading
+from typing import Awaitable, Callable, List, Optional
 from dataclasses import dataclass, field
+from engines.chat import load_chat_template
 
 
 @dataclass
 class EngineParameters:
     max_tokens: Optional[int] = 512
-    context_window: Optional[int] = 4096
+    # Caps the model's context for this request, None uses all of it
+    context_window: Optional[int] = None
+    # Slides the window when the generation outgrows it instead of stopping,
+    # keeping the BOS token and the next `keep_tokens` prompt tokens
+    context_shift: Optional[bool] = False
+    keep_tokens: Optional[int] = 0
 
     temperature: Optional[float] = 0.5
     top_k: Optional[int] = 50
@@ -74,14 +81,6 @@ class EngineParameters:
 
     stop_sequences: Optional[List[str]] = field(default_factory=list)
 
-    def ends_with_stop_sequence(self, completion: str) -> Tuple[bool, str]:
-        if not self.stop_sequences:
-            return False, ""
-        for stop_sequence in self.stop_sequences:
-            if stop_sequence in completion:
-                return True, stop_sequence
-        return False, ""
-
     @staticmethod
     def from_json(json_string: str) -> "EngineParameters":
         data = json.loads(json_string)
@@ -92,15 +91,111 @@ class EngineParameters:
         return EngineParameters(**{**EngineParameters().__dict__, **data})
 
 
+class CancellationToken:
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks: list[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self) -> None:
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        # Runs `callback` on cancellation, right away if already cancelled
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+
+def shift_amount(length: int, keep: int) -> int:
+    # Tokens dropped after the kept prefix when the window is full, half of
+    # the rest like llama.cpp's own context shift. 0 when nothing can go
+    return max(0, length - keep) // 2
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+@dataclass
+class CompletionStats:
+    # Filled in by `complete_streaming` for the caller to report
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+    stop_reason: str = ""
+    draft_accepted: int = 0
+    draft_rejected: int = 0
+    context_shifts: int = 0
+    # Set to a list by callers that want the generated token ids, engines
+    # that know them extend it before streaming the matching text
+    token_ids: list[int] | None = None
+
+    def draft(self) -> dict | None:
+        # Acceptance of speculated tokens and the resulting tokens per
+        # forward pass of the main model
+        proposed = self.draft_accepted + self.draft_rejected
+        if not proposed:
+            return None
+        passes = max(1, self.completion_tokens - self.draft_accepted)
+        return {
+            "accepted": self.draft_accepted,
+            "rejected": self.draft_rejected,
+            "acceptance_rate": self.draft_accepted / proposed,
+            "speedup": self.completion_tokens / passes,
+        }
+
+
+@dataclass
+class SessionState:
+    # An engine's snapshot of a session's KV cache, taken after each of its
+    # completions and restored before the next one when the live cache has
+    # moved on. `size` is in bytes, engines that can't snapshot leave it None
+    state: object | None = None
+    size: int = 0
+
+
+@dataclass
+class EngineConfig:
+    max_batch_size: int = 8
+    cache_tokens: int = 8192
+    prefix_cache_mb: int = 2048
+    # llama.cpp's n_ctx, from --context-window or a load's context_window option
+    context_window: int = 4096
+    threads: int | None = None
+    threads_batch: int | None = None
+    batch_tokens: int = 512
+    gpu_layers: int = -1
+    mmap: bool = True
+    mlock: bool = False
+    # Speculative decoding, with a small draft model or n-grams of the prompt
+    draft_model: str | None = None
+    draft_tokens: int = 4
+    ngram_draft: bool = False
+
+
 class Engine:
-    def __init__(self, path: str):
+    def __init__(self, path: str, config: EngineConfig | None = None):
         self.path = path
+        self.engine_config = config if config is not None else EngineConfig()
 
     def reload_model(self) -> None:
         self.unload_model()
         self.load_model()
 
-    def load_model(self) -> None:
+    def load_model(self, progress: Callable[[dict], None] | None = None) -> None:
         raise NotImplementedError
 
     def unload_model(self) -> None:
@@ -116,11 +211,48 @@ class Engine:
     def cancel_streaming(self) -> None:
         raise NotImplementedError
 
+    def count_tokens(self, text: str) -> int:
+        # Tokens `text` takes as a prompt, including the BOS token
+        raise NotImplementedError
+
+    def context_length(self) -> int:
+        # The most tokens a single sequence can hold in the loaded model
+        raise NotImplementedError
+
+    def context_limit(self, parameters: EngineParameters) -> int:
+        if parameters.context_window is None:
+            return self.context_length()
+        return min(parameters.context_window, self.context_length())
+
+    def check_context(self, parameters: EngineParameters, prompt_tokens: int) -> int:
+        # Returns the window, refusing prompts that can't be served in it
+        window = self.context_limit(parameters)
+        max_tokens = parameters.max_tokens or 0
+        if prompt_tokens >= window or (
+            not parameters.context_shift and prompt_tokens + max_tokens > window
+        ):
+            raise ValueError(
+                f"Prompt of {prompt_tokens} tokens plus {max_tokens} new tokens doesn't fit in {window} tokens of context"
+            )
+        return window
+
+    def status(self) -> dict:
+        return {}
+
+    def active_requests(self) -> int:
+        return 0
+
+    def chat_template(self) -> str | None:
+        return load_chat_template(self.path)
+
     async def complete_streaming(
         self,
         parameters: EngineParameters,
         prompt: str,
         stream: Callable[[str], Awaitable[None]] | None,
+        cancel: CancellationToken | None = None,
+        stats: CompletionStats | None = None,
+        session: SessionState | None = None,
     ) -> str:
         raise NotImplementedError
 
@@ -129,6 +261,7 @@ class EngineType(Enum):
     EXLLAMAV2 = "exllamav2"
     LLAMA_CPP = "llama-cpp"
     TRANSFORMERS = "transformers"
+    SIMULATED = "simulated"
 
     @staticmethod
     def from_str(s: str) -> "EngineType":
@@ -1,114 +1,407 @@
+import threading
 import time
+from collections import OrderedDict
 import torch
 from typing import Awaitable, Callable
-from engines.engine import Engine, EngineParameters
+from engines.engine import (
+    CancellationToken,
+    CompletionStats,
+    Engine,
+    EngineConfig,
+    EngineParameters,
+    SessionState,
+    shift_amount,
+)
+from engines.stop import StopSequenceMatcher
+from engines.worker import TokenBridge
 from exllamav2 import ExLlamaV2, ExLlamaV2Config, ExLlamaV2Cache, ExLlamaV2Tokenizer
 
-from exllamav2.generator import ExLlamaV2StreamingGenerator, ExLlamaV2Sampler
+from exllamav2.generator import (
+    ExLlamaV2DynamicGenerator,
+    ExLlamaV2DynamicJob,
+    ExLlamaV2Sampler,
+)
+
+# The paged cache allocates in pages of 256 tokens
+PAGE_SIZE = 256
+# Distinct sampler settings kept built per loaded model
+SETTINGS_CACHE_SIZE = 64
 
 
 class ExLlamaV2Engine(Engine):
-    def __init__(self, path: str):
-        self.path = path
+    def __init__(self, path: str, config: EngineConfig | None = None):
+        super().__init__(path, config)
+        self.model = None
+        self.draft_model = None
+        self.generator = None
+        self.settings = None
+        self.tokenizer = None
+        # Built sampler settings by the parameters they come from, so a
+        # preset's banned token mask is only computed once
+        self.settings_cache: OrderedDict[tuple, ExLlamaV2Sampler.Settings] = (
+            OrderedDict()
+        )
+        # The servers' threads share the cache. Not the driver's lock, so
+        # building a banned token mask never holds up decoding
+        self.settings_lock = threading.Lock()
+        self.lock = threading.Condition()
+        self.pending: list[ExLlamaV2DynamicJob] = []
+        self.cancelled: list[ExLlamaV2DynamicJob] = []
+        self.listeners: dict[ExLlamaV2DynamicJob, TokenBridge] = {}
+        self.running = False
+        self.driver = None
+        # Pages of finished jobs stay in the paged cache and are matched by
+        # hash against new prompts, so a shared prefix is only prefilled once.
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
 
-    def load_model(self) -> None:
+    def load_model(self, progress: Callable[[dict], None] | None = None) -> None:
         self.config = ExLlamaV2Config(str(self.path))
         self.model = ExLlamaV2(self.config)
-        self.cache = ExLlamaV2Cache(self.model, max_seq_len=8192, lazy=True)
-        self.model.load_autosplit(self.cache)
+        cache_tokens = max(
+            PAGE_SIZE, self.engine_config.cache_tokens // PAGE_SIZE * PAGE_SIZE
+        )
+        self.cache = ExLlamaV2Cache(self.model, max_seq_len=cache_tokens, lazy=True)
+
+        def loaded_module(module: int, modules: int):
+            if progress is not None:
+                progress({"stage": "loading", "loaded": module, "total": modules})
+
+        self.model.load_autosplit(self.cache, callback=loaded_module)
+
+        # A small model sharing the tokenizer speculates a few tokens ahead and
+        # the main model verifies them in one forward pass
+        self.draft_cache = None
+        if self.engine_config.draft_model is not None:
+            if progress is not None:
+                progress({"stage": "loading_draft"})
+            draft_config = ExLlamaV2Config(self.engine_config.draft_model)
+            self.draft_model = ExLlamaV2(draft_config)
+            self.draft_cache = ExLlamaV2Cache(
+                self.draft_model, max_seq_len=cache_tokens, lazy=True
+            )
+            self.draft_model.load_autosplit(self.draft_cache)
 
         self.tokenizer = ExLlamaV2Tokenizer(self.config)
-        self.generator = ExLlamaV2StreamingGenerator(
-            model=self.model, cache=self.cache, tokenizer=self.tokenizer
+        self.stop_conditions = [self.tokenizer.eos_token_id, 128001, 128002]
+        self.max_seq_len = min(self.config.max_seq_len, cache_tokens)
+        self.generator = ExLlamaV2DynamicGenerator(
+            model=self.model,
+            cache=self.cache,
+            tokenizer=self.tokenizer,
+            max_batch_size=self.engine_config.max_batch_size,
+            max_seq_len=self.max_seq_len,
+            draft_model=self.draft_model,
+            draft_cache=self.draft_cache,
+            num_draft_tokens=self.engine_config.draft_tokens,
+            use_ngram_draft=self.draft_model is None and self.engine_config.ngram_draft,
         )
-        self.generator.set_stop_conditions(
-            [self.tokenizer.eos_token_id, 128001, 128002]
-        )
-        self.settings = ExLlamaV2Sampler.Settings()
         self.apply_parameters(EngineParameters())
 
+        if progress is not None:
+            progress({"stage": "warmup"})
         self.generator.warmup()
 
+        self.running = True
+        self.driver = threading.Thread(target=self.drive, daemon=True)
+        self.driver.start()
+
     def unload_model(self) -> None:
         if self.model is None:
             return
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        if self.driver is not None:
+            self.driver.join()
+            self.driver = None
         self.model.unload()
-        del self.model
+        if self.draft_model is not None:
+            self.draft_model.unload()
+            self.draft_model = None
+            self.draft_cache = None
         del self.cache
-        del self.tokenizer
         del self.generator
-        del self.settings
+        self.model = None
+        self.draft_model = None
+        self.generator = None
+        self.tokenizer = None
+        self.settings = None
+        with self.settings_lock:
+            self.settings_cache.clear()
         torch.cuda.empty_cache()
 
     def apply_parameters(self, parameters: EngineParameters) -> None:
-        if self.settings is None or self.tokenizer is None:
+        self.settings = self.build_settings(parameters)
+
+    def settings_for(self, parameters: EngineParameters) -> ExLlamaV2Sampler.Settings:
+        key = (
+            parameters.repetition_penalty,
+            parameters.repetition_penalty_range,
+            parameters.temperature,
+            parameters.smoothing_factor,
+            parameters.top_k,
+            parameters.top_p,
+            parameters.top_a,
+            parameters.min_p,
+            parameters.tfs,
+            parameters.mirostat,
+            parameters.mirostat_tau,
+            parameters.mirostat_eta,
+            tuple(parameters.banned_tokens or ()),
+        )
+        with self.settings_lock:
+            settings = self.settings_cache.get(key)
+            if settings is None:
+                settings = self.build_settings(parameters)
+                self.settings_cache[key] = settings
+                if len(self.settings_cache) > SETTINGS_CACHE_SIZE:
+                    self.settings_cache.popitem(last=False)
+            else:
+                self.settings_cache.move_to_end(key)
+        # Jobs keep sampling state like mirostat's mu in their settings
+        return settings.clone()
+
+    def build_settings(self, parameters: EngineParameters) -> ExLlamaV2Sampler.Settings:
+        if self.tokenizer is None:
             raise RuntimeError("No model loaded")
 
-        self.settings.token_repetition_penalty = parameters.repetition_penalty
-        self.settings.token_repetition_range = parameters.repetition_penalty_range
+        settings = ExLlamaV2Sampler.Settings()
+        settings.token_repetition_penalty = parameters.repetition_penalty
+        settings.token_repetition_range = parameters.repetition_penalty_range
 
-        self.settings.temperature = parameters.temperature
-        self.settings.smoothing_factor = parameters.smoothing_factor
+        settings.temperature = parameters.temperature
+        settings.smoothing_factor = parameters.smoothing_factor
 
-        self.settings.top_k = parameters.top_k
-        self.settings.top_p = parameters.top_p
-        self.settings.top_a = parameters.top_a
-        self.settings.min_p = parameters.min_p
-        self.settings.tfs = parameters.tfs
+        settings.top_k = parameters.top_k
+        settings.top_p = parameters.top_p
+        settings.top_a = parameters.top_a
+        settings.min_p = parameters.min_p
+        settings.tfs = parameters.tfs
 
-        self.settings.mirostat = parameters.mirostat
-        self.settings.mirostat_tau = parameters.mirostat_tau
-        self.settings.mirostat_eta = parameters.mirostat_eta
+        settings.mirostat = parameters.mirostat
+        settings.mirostat_tau = parameters.mirostat_tau
+        settings.mirostat_eta = parameters.mirostat_eta
 
-        self.settings.disallow_tokens(self.tokenizer, parameters.banned_tokens)
+        settings.disallow_tokens(self.tokenizer, parameters.banned_tokens)
+        return settings
 
     def cancel_streaming(self) -> None:
-        self.streaming = False
+        with self.lock:
+            self.cancelled.extend(self.listeners.keys())
+            self.lock.notify_all()
+
+    def active_requests(self) -> int:
+        with self.lock:
+            return len(self.listeners)
+
+    def cancel_job(self, job: ExLlamaV2DynamicJob) -> None:
+        with self.lock:
+            if job in self.listeners:
+                self.cancelled.append(job)
+                self.lock.notify_all()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "cache_tokens": self.cache.max_seq_len if self.model else None,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_prompt_tokens": self.cached_tokens,
+            }
+
+    def drive(self) -> None:
+        # Owns the generator: every running job advances by one step per
+        # iteration and new jobs join the batch as soon as they're enqueued.
+        while True:
+            with self.lock:
+                while (
+                    self.running
+                    and not self.pending
+                    and not self.cancelled
+                    and not self.generator.num_remaining_jobs()
+                ):
+                    self.lock.wait()
+                if not self.running:
+                    for job in list(self.listeners.keys()):
+                        self.dispatch(job, {"eos": True, "eos_reason": "unloaded"})
+                    break
+                for job in self.pending:
+                    # A job that can't fit in the cache fails on its own
+                    # instead of taking the driver down with it
+                    try:
+                        self.generator.enqueue(job)
+                    except Exception as e:
+                        self.dispatch(job, e)
+                self.pending.clear()
+                for job in self.cancelled:
+                    if job in self.listeners:
+                        self.generator.cancel(job)
+                        self.dispatch(job, {"eos": True, "eos_reason": "cancelled"})
+                self.cancelled.clear()
+            if not self.generator.num_remaining_jobs():
+                continue
+            try:
+                results = self.generator.iterate()
+            except Exception as e:
+                with self.lock:
+                    for job in list(self.listeners.keys()):
+                        self.generator.cancel(job)
+                        self.dispatch(job, e)
+                continue
+            with self.lock:
+                for result in results:
+                    if result["stage"] != "streaming":
+                        continue
+                    self.dispatch(result["job"], result)
+
+    def dispatch(self, job: ExLlamaV2DynamicJob, result) -> None:
+        bridge = self.listeners.get(job)
+        if bridge is None:
+            return
+        if isinstance(result, Exception):
+            del self.listeners[job]
+            bridge.fail(result)
+            return
+        if result["eos"]:
+            del self.listeners[job]
+        bridge.put(result)
+
+    def count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            raise RuntimeError("No model loaded")
+        return self.tokenizer.encode(text, add_bos=True).shape[-1]
+
+    def context_length(self) -> int:
+        if self.generator is None:
+            raise RuntimeError("No model loaded")
+        return self.max_seq_len
+
+    def submit(self, job: ExLlamaV2DynamicJob) -> TokenBridge:
+        bridge = TokenBridge()
+        with self.lock:
+            self.listeners[job] = bridge
+            self.pending.append(job)
+            self.lock.notify_all()
+        return bridge
 
     async def complete_streaming(
         self,
         parameters: EngineParameters,
         prompt: str,
         stream: Callable[[str], Awaitable[None]] | None,
+        cancel: CancellationToken | None = None,
+        stats: CompletionStats | None = None,
+        session: SessionState | None = None,
     ) -> str:
-        if self.generator is None or self.settings is None or self.tokenizer is None:
+        if self.generator is None or self.tokenizer is None:
             raise RuntimeError("No model loaded")
-
-        self.apply_parameters(parameters)
+        # The paged cache can't be exported, so sessions aren't snapshotted.
+        # Their pages are still matched by hash while they stay in the cache
 
         input_ids = self.tokenizer.encode(prompt, add_bos=True)
         if isinstance(input_ids, tuple):
             raise ValueError("Can't handle multiple input_ids")
-        self.streaming = True
-        self.generator.begin_stream_ex(input_ids, self.settings)
+        window = self.check_context(parameters, input_ids.shape[-1])
+        keep = 1 + (parameters.keep_tokens or 0)
+        gen_settings = self.settings_for(parameters)
 
+        stop_matcher = StopSequenceMatcher(parameters.stop_sequences)
         completion = ""
+        token_count = 0
+        cached_tokens = 0
+        accepted = rejected = 0
+        shifts = 0
         stop_reason = ""
+        sequence = input_ids
+        job = None
+        if cancel is not None:
+            cancel.on_cancel(lambda: self.cancel_job(job))
         time_start = time.time()
-        while True:
-            res = self.generator.stream_ex()
-            chunk, eos = res["chunk"], res["eos"]
-
-            completion += chunk
-
-            if stream:
-                await stream(chunk)
-
-            if eos:
-                stop_reason = "EOS"
-                break
-            if len(completion) >= parameters.max_tokens:
-                stop_reason = "max_tokens"
-                break
-            ends, seq = parameters.ends_with_stop_sequence(chunk)
-            if ends:
-                stop_reason = f"stop_sequences ({seq})"
-                break
-            if not self.streaming:
-                stop_reason = "cancelled"
-                break
+        try:
+            # The paged cache can't move entries to other positions, so when
+            # the window fills up the job is replaced by one on the shifted
+            # sequence. Pages of the kept prefix are still matched by hash,
+            # only the rest of the window is prefilled again.
+            while True:
+                job = ExLlamaV2DynamicJob(
+                    input_ids=sequence,
+                    max_new_tokens=min(
+                        parameters.max_tokens - token_count,
+                        window - sequence.shape[-1],
+                    ),
+                    gen_settings=gen_settings,
+                    stop_conditions=self.stop_conditions,
+                    decode_special_tokens=not parameters.skip_special_tokens,
+                )
+                bridge = self.submit(job)
+                if cancel is not None and cancel.cancelled:
+                    self.cancel_job(job)
+                generated = []
+                shift = False
+                async for res in bridge:
+                    token_ids = res.get("token_ids")
+                    if token_ids is not None:
+                        token_count += token_ids.shape[-1]
+                        generated.append(token_ids)
+                        if stats is not None and stats.token_ids is not None:
+                            stats.token_ids.extend(token_ids.flatten().tolist())
+
+                    shift = (
+                        res["eos"]
+                        and res.get("eos_reason") == "max_new_tokens"
+                        and parameters.context_shift
+                        and token_count < parameters.max_tokens
+                    )
+                    chunk, seq = stop_matcher.feed(res.get("text", ""))
+                    if res["eos"] and not shift:
+                        chunk += stop_matcher.flush()
+                    completion += chunk
+
+                    if stream and chunk:
+                        await stream(chunk)
+
+                    if seq is not None:
+                        stop_reason = f"stop_sequences ({seq})"
+                        break
+                    if res["eos"]:
+                        stop_reason = res.get("eos_reason", "EOS")
+                        if not shifts:
+                            cached_tokens = res.get("cached_tokens", 0)
+                        accepted += res.get("accepted_draft_tokens", 0)
+                        rejected += res.get("rejected_draft_tokens", 0)
+                        with self.lock:
+                            self.prompt_tokens += res.get("prompt_tokens", 0)
+                            self.cached_tokens += res.get("cached_tokens", 0)
+                        break
+                if not shift or stop_reason != "max_new_tokens":
+                    break
+                sequence = torch.cat([sequence] + generated, dim=-1)
+                discard = shift_amount(sequence.shape[-1], keep)
+                if not discard:
+                    stop_reason = "context"
+                    break
+                sequence = torch.cat(
+                    [sequence[:, :keep], sequence[:, keep + discard :]], dim=-1
+                )
+                shifts += 1
+        finally:
+            if job is not None:
+                self.cancel_job(job)
         time_end = time.time()
+        if stats is not None:
+            stats.prompt_tokens = input_ids.shape[-1]
+            stats.cached_tokens = cached_tokens
+            stats.completion_tokens = token_count
+            stats.stop_reason = stop_reason
+            stats.draft_accepted = accepted
+            stats.draft_rejected = rejected
+            stats.context_shifts = shifts
+        drafted = ""
+        if accepted + rejected:
+            drafted = f", accepted {accepted}/{accepted + rejected} draft tokens"
+        if shifts:
+            drafted += f", shifted the context {shifts} times"
         print(
-            f"Generated {len(completion)} tokens in {time_end - time_start:.2f}s at a rate of {len(completion) / (time_end - time_start):.2f} tokens/s, generation stopped because of {stop_reason}"
+            f"Generated {token_count} tokens in {time_end - time_start:.2f}s at a rate of {token_count / (time_end - time_start):.2f} tokens/s, reused {cached_tokens}/{input_ids.shape[-1]} prompt tokens{drafted}, generation stopped because of {stop_reason}"
         )
         return completion
@@ -1,76 +1,375 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
 from typing import Awaitable, Callable
 
-from engines.engine import Engine, EngineParameters
-from llama_cpp import Llama, StoppingCriteria
+from engines.engine import (
+    CancellationToken,
+    CompletionStats,
+    Engine,
+    EngineConfig,
+    EngineParameters,
+    SessionState,
+    shift_amount,
+)
+from engines.stop import StopSequenceMatcher
+from engines.worker import iterate_in_worker
+import numpy as np
+from llama_cpp import Llama, LlamaRAMCache, StoppingCriteria
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+
+class PrefixCache(LlamaRAMCache):
+    # LRU of saved model states keyed by token prefix, counting lookups
+    def __init__(self, capacity_bytes: int):
+        super().__init__(capacity_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self, key):
+        try:
+            state = super().__getitem__(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return state
+
+
+class SmallModelDraft(LlamaDraftModel):
+    # Greedily continues the sequence with a smaller model sharing the
+    # vocabulary. `generate` reuses the longest common prefix, so only the
+    # tokens accepted since the last call are evaluated again.
+    def __init__(self, llama: Llama, num_pred_tokens: int):
+        self.llama = llama
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft = []
+        for token in self.llama.generate(input_ids.tolist(), top_k=1, temp=0.0):
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+        return np.array(draft, dtype=np.intc)
+
+
+class CountingDraft(LlamaDraftModel):
+    # llama.cpp doesn't report how many drafted tokens were kept. Every call
+    # passes the sequence so far, which holds the accepted part of the
+    # previous proposal followed by one sampled token, so it's compared
+    # against what was proposed last time.
+    def __init__(self, draft: LlamaDraftModel):
+        self.draft = draft
+        self.reset()
+
+    def reset(self) -> None:
+        self.accepted = 0
+        self.rejected = 0
+        self.proposed_at = 0
+        self.proposal: list[int] = []
+
+    def __call__(self, input_ids, /, **kwargs):
+        if self.proposal:
+            new = input_ids[self.proposed_at : -1].tolist()
+            accepted = 0
+            while (
+                accepted < min(len(new), len(self.proposal))
+                and new[accepted] == self.proposal[accepted]
+            ):
+                accepted += 1
+            self.accepted += accepted
+            self.rejected += len(self.proposal) - accepted
+        proposal = self.draft(input_ids, **kwargs)
+        self.proposed_at = len(input_ids)
+        self.proposal = proposal.tolist()
+        return proposal
 
 
 class LlamaCppEngine(Engine):
-    def __init__(self, path: str):
-        self.path = path
-        self.streaming = False
+    def __init__(self, path: str, config: EngineConfig | None = None):
+        super().__init__(path, config)
+        self.cancellations: set[CancellationToken] = set()
+        self.llama: Llama | None = None
+        self.draft_llama: Llama | None = None
+        self.draft: CountingDraft | None = None
+        # Llama isn't thread-safe, so all generation runs on one worker thread
+        self.worker = ThreadPoolExecutor(max_workers=1)
 
-    def load_model(self) -> None:
-        self.llama = Llama(str(self.path), n_ctx=4096, n_gpu_layers=99999, verbose=False)
+    def load_model(self, progress: Callable[[dict], None] | None = None) -> None:
+        if progress is not None:
+            progress({"stage": "loading"})
+        config = self.engine_config
+        if config.draft_model is not None:
+            self.draft_llama = Llama(
+                config.draft_model,
+                n_ctx=config.context_window,
+                n_batch=config.batch_tokens,
+                n_threads=config.threads,
+                n_threads_batch=config.threads_batch,
+                n_gpu_layers=config.gpu_layers,
+                use_mmap=config.mmap,
+                verbose=False,
+            )
+            self.draft = CountingDraft(
+                SmallModelDraft(self.draft_llama, config.draft_tokens)
+            )
+        elif config.ngram_draft:
+            self.draft = CountingDraft(
+                LlamaPromptLookupDecoding(num_pred_tokens=config.draft_tokens)
+            )
+        self.llama = Llama(
+            str(self.path),
+            n_ctx=config.context_window,
+            n_batch=config.batch_tokens,
+            n_threads=config.threads,
+            n_threads_batch=config.threads_batch,
+            n_gpu_layers=config.gpu_layers,
+            use_mmap=config.mmap,
+            use_mlock=config.mlock,
+            draft_model=self.draft,
+            verbose=False,
+        )
+        self.prefix_cache = PrefixCache(self.engine_config.prefix_cache_mb << 20)
+        self.llama.set_cache(self.prefix_cache)
 
     def unload_model(self) -> None:
-        if self.llama:
-            del self.llama
-        pass
+        self.cancel_streaming()
+        llama, self.llama = self.llama, None
+        if llama is not None:
+            # Frees the model once the worker is done with it
+            self.worker.submit(llama.close).result()
+        draft_llama, self.draft_llama = self.draft_llama, None
+        if draft_llama is not None:
+            self.worker.submit(draft_llama.close).result()
+        self.draft = None
 
     def apply_parameters(self, parameters: EngineParameters) -> None:
         pass
 
+    def status(self) -> dict:
+        return {
+            "prefix_cache_bytes": self.prefix_cache.cache_size,
+            "prefix_cache_capacity": self.prefix_cache.capacity_bytes,
+            "prefix_cache_hits": self.prefix_cache.hits,
+            "prefix_cache_misses": self.prefix_cache.misses,
+        }
+
+    def chat_template(self) -> str | None:
+        return self.llama.metadata.get("tokenizer.chat_template")
+
+    def active_requests(self) -> int:
+        return len(self.cancellations)
+
     def cancel_streaming(self) -> None:
-        self.streaming = False
+        for cancel in list(self.cancellations):
+            cancel.cancel()
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.llama.tokenize(text.encode("utf-8")))
+
+    def context_length(self) -> int:
+        return self.llama.n_ctx()
+
+    def cached_prefix(self, tokens: list[int]) -> int:
+        # Prompt tokens the next call won't evaluate, from the live cache or
+        # the prefix cache entry it will load. The last token is always
+        # evaluated again for its logits
+        llama = self.llama
+        cached = Llama.longest_token_prefix(
+            llama.input_ids[: llama.n_tokens].tolist(), tokens
+        )
+        key = self.prefix_cache._find_longest_prefix_key(tuple(tokens))
+        if key is not None:
+            cached = max(cached, Llama.longest_token_prefix(key, tokens))
+        return min(cached, max(len(tokens) - 1, 0))
+
+    def restore_session(self, state, tokens: list[int]) -> None:
+        # Only loads the snapshot when it holds more of the prompt than the
+        # live cache, which it won't if the session was the last one to run
+        live = Llama.longest_token_prefix(
+            self.llama.input_ids[: self.llama.n_tokens].tolist(), tokens
+        )
+        saved = Llama.longest_token_prefix(
+            state.input_ids[: state.n_tokens].tolist(), tokens
+        )
+        if saved <= live:
+            return
+        try:
+            self.llama.load_state(state)
+        except Exception as e:
+            # A snapshot from a model loaded with other settings
+            print(f"Failed to restore session state: {str(e)}")
+            self.llama.reset()
+
+    def shift_context(self, tokens: list[int], keep: int) -> list[int] | None:
+        # Drops tokens after the kept prefix and moves the rest of the KV
+        # cache back in place, so only tokens the cache is missing are
+        # evaluated again. `tokens` is the prompt plus the generated text
+        # tokenized again, the model's own view is trusted up to where the
+        # two agree.
+        discard = shift_amount(len(tokens), keep)
+        if not discard:
+            return None
+        llama = self.llama
+        valid = Llama.longest_token_prefix(
+            llama.input_ids[: llama.n_tokens].tolist(), tokens
+        )
+        if valid > keep + discard:
+            llama._ctx.kv_cache_seq_rm(-1, valid, -1)
+            llama._ctx.kv_cache_seq_rm(-1, keep, keep + discard)
+            llama._ctx.kv_cache_seq_shift(-1, keep + discard, valid, -discard)
+            llama.input_ids[keep : valid - discard] = llama.input_ids[
+                keep + discard : valid
+            ]
+            llama.n_tokens = valid - discard
+        else:
+            llama.n_tokens = min(valid, keep)
+            llama._ctx.kv_cache_seq_rm(-1, llama.n_tokens, -1)
+        if self.draft is not None:
+            # The last proposal was made for positions that moved
+            self.draft.proposal = []
+        return tokens[:keep] + tokens[keep + discard :]
 
     async def complete_streaming(
         self,
         parameters: EngineParameters,
         prompt: str,
         stream: Callable[[str], Awaitable[None]] | None,
+        cancel: CancellationToken | None = None,
+        stats: CompletionStats | None = None,
+        session: SessionState | None = None,
     ) -> str:
-        self.streaming = True
+        cancel = cancel if cancel is not None else CancellationToken()
+        self.cancellations.add(cancel)
         completion = ""
         stop_reason = ""
         time_start = time.time()
-        generator = self.llama(
-            prompt,
-            top_k=parameters.top_k,
-            top_p=parameters.top_p,
-            min_p=parameters.min_p,
-            typical_p=parameters.typical_p,
-            temperature=parameters.temperature,
-            repeat_penalty=parameters.repetition_penalty,
-            frequency_penalty=parameters.frequency_penalty,
-            presence_penalty=parameters.presence_penalty,
-            tfs_z=parameters.tfs,
-            mirostat_mode=parameters.mirostat_mode,
-            mirostat_eta=parameters.mirostat_eta,
-            mirostat_tau=parameters.mirostat_tau,
-            stop=parameters.stop_sequences,
-            stream=True,
-            max_tokens=parameters.max_tokens
-        )
+        shifts = 0
+        draft_counts: tuple[int, int] | None = None
+
+        def generate():
+            nonlocal draft_counts
+            if cancel.cancelled:
+                return
+            tokens = self.llama.tokenize(prompt.encode("utf-8"))
+            if stats is not None:
+                stats.prompt_tokens = len(tokens)
+            window = self.check_context(parameters, len(tokens))
+            keep = 1 + (parameters.keep_tokens or 0)
+            if self.draft is not None:
+                self.draft.reset()
+            if session is not None and session.state is not None:
+                self.restore_session(session.state, tokens)
+            if stats is not None:
+                stats.cached_tokens = self.cached_prefix(tokens)
+            try:
+                yield from shifting_rounds(tokens, window, keep)
+            finally:
+                if self.draft is not None:
+                    # The draft is shared, the next request resets its counts
+                    draft_counts = (self.draft.accepted, self.draft.rejected)
+                if session is not None:
+                    # Taken here, before the worker runs anything else
+                    session.state = self.llama.save_state()
+                    session.size = (
+                        session.state.llama_state_size
+                        + session.state.scores.nbytes
+                        + session.state.input_ids.nbytes
+                    )
+
+        def shifting_rounds(tokens: list[int], window: int, keep: int):
+            nonlocal shifts
+            remaining = parameters.max_tokens
+            while True:
+                text = ""
+                for response in self.llama(
+                    tokens,
+                    top_k=parameters.top_k,
+                    top_p=parameters.top_p,
+                    min_p=parameters.min_p,
+                    typical_p=parameters.typical_p,
+                    temperature=parameters.temperature,
+                    repeat_penalty=parameters.repetition_penalty,
+                    frequency_penalty=parameters.frequency_penalty,
+                    presence_penalty=parameters.presence_penalty,
+                    tfs_z=parameters.tfs,
+                    mirostat_mode=parameters.mirostat_mode,
+                    mirostat_eta=parameters.mirostat_eta,
+                    mirostat_tau=parameters.mirostat_tau,
+                    stream=True,
+                    max_tokens=min(remaining, window - len(tokens)),
+                ):
+                    choice = response["choices"][0]
+                    text += choice["text"]
+                    if (
+                        choice["finish_reason"] != "length"
+                        or not parameters.context_shift
+                    ):
+                        yield response
+                        continue
+                    generated = self.llama.tokenize(
+                        text.encode("utf-8"), add_bos=False, special=True
+                    )
+                    remaining -= len(generated)
+                    if remaining <= 0:
+                        yield response
+                        return
+                    shifted = self.shift_context(tokens + generated, keep)
+                    if shifted is None:
+                        choice["finish_reason"] = "context"
+                        yield response
+                        return
+                    choice["finish_reason"] = None
+                    yield response
+                    tokens = shifted
+                    shifts += 1
+                    break
+                else:
+                    return
+
+        stop_matcher = StopSequenceMatcher(parameters.stop_sequences)
         token_count = 0
-        for response in generator:
-            token = response["choices"][0]["text"]
-            stop_reason = response["choices"][0]["finish_reason"]
-            completion += token
-            token_count += 1
-            print(token, end="", flush=True)
-
-            if stream:
-                await stream(token)
-            ends, seq = parameters.ends_with_stop_sequence(token)
-            if ends:
-                stop_reason = f"stop_sequences ({seq})"
-                break
-            if not self.streaming:
-                stop_reason = "cancelled"
-                break
+        try:
+            async with aclosing(iterate_in_worker(self.worker, generate)) as responses:
+                async for response in responses:
+                    token, seq = stop_matcher.feed(response["choices"][0]["text"])
+                    stop_reason = response["choices"][0]["finish_reason"]
+                    if stop_reason is not None:
+                        token += stop_matcher.flush()
+                    completion += token
+                    token_count += 1
+
+                    if stream and token:
+                        await stream(token)
+                    if seq is not None:
+                        stop_reason = f"stop_sequences ({seq})"
+                        break
+                    if cancel.cancelled:
+                        stop_reason = "cancelled"
+                        break
+                else:
+                    tail = stop_matcher.flush()
+                    completion += tail
+                    if stream and tail:
+                        await stream(tail)
+        finally:
+            self.cancellations.discard(cancel)
         time_end = time.time()
+        if stats is not None:
+            stats.completion_tokens = token_count
+            stats.stop_reason = stop_reason or ""
+            stats.context_shifts = shifts
+        drafted = ""
+        if draft_counts is not None:
+            accepted, rejected = draft_counts
+            if stats is not None:
+                stats.draft_accepted = accepted
+                stats.draft_rejected = rejected
+            if accepted + rejected:
+                drafted = f", accepted {accepted}/{accepted + rejected} draft tokens"
+        if shifts:
+            drafted += f", shifted the context {shifts} times"
         print(
-            f"Generated {token_count} tokens in {time_end - time_start:.2f}s at a rate of {token_count / (time_end - time_start):.2f} tokens/s, generation stopped because of {stop_reason}"
+            f"Generated {token_count} tokens in {time_end - time_start:.2f}s at a rate of {token_count / (time_end - time_start):.2f} tokens/s{drafted}, generation stopped because of {stop_reason}"
         )
         return completion
@@ -0,0 +1,18 @@
+import importlib
+
+from engines.engine import Engine, EngineType
+
+# Backends are imported on first use so their heavy dependencies (torch,
+# exllamav2, llama.cpp) are only loaded when a model actually needs them
+ENGINES: dict[EngineType, str] = {
+    EngineType.EXLLAMAV2: "engines.exllamav2:ExLlamaV2Engine",
+    EngineType.LLAMA_CPP: "engines.llama_cpp:LlamaCppEngine",
+    EngineType.SIMULATED: "engines.simulated:SimulatedEngine",
+}
+
+
+def engine_class(engine: EngineType) -> type[Engine]:
+    if engine not in ENGINES:
+        raise NotImplementedError(f"Engine {engine} not implemented")
+    module, name = ENGINES[engine].split(":")
+    return getattr(importlib.import_module(module), name)
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from engines.engine import (
+    CancellationToken,
+    CompletionStats,
+    Engine,
+    EngineConfig,
+    EngineParameters,
+    SessionState,
+    shift_amount,
+)
+from engines.stop import StopSequenceMatcher
+
+WORDS = (
+    "the quick brown fox jumps over the lazy dog while a small model "
+    "pretends to think about every token it produces"
+).split()
+
+
+# Generates filler text at a configured prefill and decode speed without
+# touching a GPU, so the servers, scheduler and serialization can be load
+# tested on any machine. Speeds are read from `simulated.json` in the model
+# directory, anything missing falls back to SETTINGS.
+class SimulatedEngine(Engine):
+    SETTINGS = {
+        # Prompt tokens processed per second
+        "prefill_tokens_per_sec": 2000.0,
+        # Tokens generated per second by a single completion
+        "decode_tokens_per_sec": 50.0,
+        # Relative slowdown of every decode step per extra running completion
+        "batch_slowdown": 0.02,
+        "load_sec": 0.0,
+        # Size of a session's KV snapshot
+        "session_bytes_per_token": 131072,
+    }
+
+    def __init__(self, path: str, config: EngineConfig | None = None):
+        super().__init__(path, config)
+        self.settings = dict(self.SETTINGS)
+        self.cancellations: set[CancellationToken] = set()
+
+    def load_model(self, progress: Callable[[dict], None] | None = None) -> None:
+        settings_path = Path(self.path) / "simulated.json"
+        if settings_path.exists():
+            self.settings.update(json.loads(settings_path.read_text()))
+        if progress is not None:
+            progress({"stage": "loading"})
+        time.sleep(self.settings["load_sec"])
+
+    def unload_model(self) -> None:
+        self.cancel_streaming()
+
+    def apply_parameters(self, parameters: EngineParameters) -> None:
+        pass
+
+    def active_requests(self) -> int:
+        return len(self.cancellations)
+
+    def cancel_streaming(self) -> None:
+        for cancel in list(self.cancellations):
+            cancel.cancel()
+
+    def chat_template(self) -> str | None:
+        return None
+
+    def count_tokens(self, text: str) -> int:
+        # Roughly four characters per token
+        return max(1, len(text) // 4)
+
+    def context_length(self) -> int:
+        return self.engine_config.context_window
+
+    async def complete_streaming(
+        self,
+        parameters: EngineParameters,
+        prompt: str,
+        stream: Callable[[str], Awaitable[None]] | None,
+        cancel: CancellationToken | None = None,
+        stats: CompletionStats | None = None,
+        session: SessionState | None = None,
+    ) -> str:
+        cancel = cancel if cancel is not None else CancellationToken()
+        self.cancellations.add(cancel)
+        prompt_tokens = self.count_tokens(prompt)
+        window = self.check_context(parameters, prompt_tokens)
+        # A session's snapshot is the number of tokens it holds, assuming the
+        # prompt continues it
+        cached_tokens = 0
+        if session is not None and session.state is not None:
+            cached_tokens = min(session.state, prompt_tokens - 1)
+        length = prompt_tokens
+        shifts = 0
+        stop_matcher = StopSequenceMatcher(parameters.stop_sequences)
+        completion = ""
+        token_count = 0
+        stop_reason = "length"
+        try:
+            await asyncio.sleep(
+                (prompt_tokens - cached_tokens) / self.settings["prefill_tokens_per_sec"]
+            )
+            for i in range(parameters.max_tokens or 0):
+                if cancel.cancelled:
+                    stop_reason = "cancelled"
+                    break
+                if length >= window:
+                    discard = shift_amount(length, 1 + (parameters.keep_tokens or 0))
+                    if not discard:
+                        stop_reason = "context"
+                        break
+                    length -= discard
+                    shifts += 1
+                length += 1
+                slowdown = 1 + self.settings["batch_slowdown"] * (
+                    len(self.cancellations) - 1
+                )
+                await asyncio.sleep(slowdown / self.settings["decode_tokens_per_sec"])
+                token_count += 1
+                if stats is not None and stats.token_ids is not None:
+                    stats.token_ids.append(i % len(WORDS))
+                chunk, seq = stop_matcher.feed(" " + WORDS[i % len(WORDS)])
+                completion += chunk
+                if stream and chunk:
+                    await stream(chunk)
+                if seq is not None:
+                    stop_reason = f"stop_sequences ({seq})"
+                    break
+            else:
+                tail = stop_matcher.flush()
+                completion += tail
+                if stream and tail:
+                    await stream(tail)
+        finally:
+            self.cancellations.discard(cancel)
+        if session is not None:
+            session.state = length
+            session.size = length * self.settings["session_bytes_per_token"]
+        if stats is not None:
+            stats.prompt_tokens = prompt_tokens
+            stats.cached_tokens = cached_tokens
+            stats.completion_tokens = token_count
+            stats.stop_reason = stop_reason
+            stats.context_shifts = shifts
+        return completion
@@ -0,0 +1,74 @@
+from collections import deque
+from typing import List, Optional, Tuple
+
+
+# Aho-Corasick automaton over all stop sequences, fed the completion chunk by
+# chunk. Text that could still turn out to be the start of a stop sequence is
+# held back until it's either matched or ruled out, so a stop sequence split
+# across chunks is caught and never streamed to the client.
+class StopSequenceMatcher:
+    def __init__(self, stop_sequences: Optional[List[str]]):
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.depth: list[int] = [0]
+        self.match: list[Optional[str]] = [None]
+        for stop_sequence in stop_sequences or []:
+            if stop_sequence:
+                self.insert(stop_sequence)
+        self.build()
+        self.state = 0
+        self.held = ""
+
+    def insert(self, stop_sequence: str) -> None:
+        node = 0
+        for char in stop_sequence:
+            if char not in self.goto[node]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[node] + 1)
+                self.match.append(None)
+                self.goto[node][char] = len(self.goto) - 1
+            node = self.goto[node][char]
+        self.match[node] = stop_sequence
+
+    def build(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                # A node's own sequence is the longest one ending here, so it
+                # also starts earliest; otherwise inherit the suffix match
+                if self.match[child] is None:
+                    self.match[child] = self.match[self.fail[child]]
+                queue.append(child)
+
+    def step(self, char: str) -> int:
+        node = self.state
+        while node and char not in self.goto[node]:
+            node = self.fail[node]
+        return self.goto[node].get(char, 0)
+
+    def feed(self, chunk: str) -> Tuple[str, Optional[str]]:
+        # Returns the text that is safe to emit and the stop sequence, if any
+        buffer = self.held + chunk
+        for i, char in enumerate(chunk):
+            self.state = self.step(char)
+            stop_sequence = self.match[self.state]
+            if stop_sequence is not None:
+                end = len(self.held) + i + 1
+                self.state = 0
+                self.held = ""
+                return buffer[: end - len(stop_sequence)], stop_sequence
+        keep = self.depth[self.state]
+        self.held = buffer[len(buffer) - keep :]
+        return buffer[: len(buffer) - keep], None
+
+    def flush(self) -> str:
+        held = self.held
+        self.state = 0
+        self.held = ""
+        return held
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+from concurrent.futures import Executor
+from typing import AsyncIterator, Callable, Iterator
+
+
+class _Done:
+    pass
+
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+# Hands items produced on a worker thread to a coroutine on the event loop
+# that created the bridge, without blocking either side.
+class TokenBridge:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, item) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    def done(self) -> None:
+        self.put(_Done())
+
+    def fail(self, error: BaseException) -> None:
+        self.put(_Failed(error))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if isinstance(item, _Done):
+            raise StopAsyncIteration
+        if isinstance(item, _Failed):
+            raise item.error
+        return item
+
+
+async def iterate_in_worker(
+    executor: Executor, make_iterator: Callable[[], Iterator]
+) -> AsyncIterator:
+    # Drives a blocking iterator on `executor` and yields its items on the
+    # event loop. Closing the async iterator early stops the worker after the
+    # item it is currently producing.
+    bridge = TokenBridge()
+    stop = threading.Event()
+
+    def work():
+        try:
+            iterator = make_iterator()
+            try:
+                for item in iterator:
+                    bridge.put(item)
+                    if stop.is_set():
+                        break
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+        except BaseException as e:
+            bridge.fail(e)
+        finally:
+            bridge.done()
+
+    future = asyncio.get_running_loop().run_in_executor(executor, work)
+    try:
+        async for item in bridge:
+            yield item
+    finally:
+        stop.set()
+        await asyncio.shield(future)
@@ -1,27 +1,74 @@
+import asyncio
 import json
-from fastapi import FastAPI
+import time
+import uuid
+from fastapi import FastAPI, Request as HttpRequest
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from models import ModelManager
 from embed import EmbedManager
+import metrics
 from engines.engine import EngineType, EngineParameters
+from request import IResponder, Request, Response
+from scheduler import Priority
 import uvicorn
 
 
 class TextRequest(BaseModel):
     text: str
+    engine_parameters: dict | None = None
+
+
+class BatchTextRequest(BaseModel):
+    texts: list[str]
+
+
+class QueueResponder(IResponder):
+    def __init__(self, model_manager: ModelManager, client: str):
+        super().__init__(model_manager)
+        self.client = client
+        self.priority = Priority.INTERACTIVE
+        self.queue: asyncio.Queue[tuple[bool, Response]] = asyncio.Queue()
+        self.task: asyncio.Task | None = None
+
+    async def response(self, response: Response):
+        await self.queue.put((True, response))
+
+    async def intermediate_response(self, response: Response):
+        await self.queue.put((False, response))
+
+
+def engine_parameters(body: dict) -> dict:
+    # Takes any EngineParameters field plus the OpenAI names that differ.
+    # OpenAI clients send null for "use the default", so those are left out
+    parameters = {
+        key: value
+        for key, value in body.items()
+        if key in EngineParameters.__dataclass_fields__ and value is not None
+    }
+    if body.get("max_completion_tokens") is not None:
+        parameters["max_tokens"] = body["max_completion_tokens"]
+    stop = body.get("stop")
+    if stop:
+        parameters["stop_sequences"] = [stop] if isinstance(stop, str) else stop
+    return parameters
+
+
+def sse(data: dict | str) -> str:
+    return f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n"
 
 
 def start(host: str,
           port: int,
           model_manager: ModelManager,
-          embed_manager: EmbedManager):
+          embed_manager: EmbedManager | None):
     import threading
 
     thread = threading.Thread(target=run, args=(host, port, model_manager, embed_manager))
     thread.start()
 
 
-def run(host: str, port: int, model_manager: ModelManager, embed_manager: EmbedManager):
+def run(host: str, port: int, model_manager: ModelManager, embed_manager: EmbedManager | None):
     app = FastAPI()
 
     @app.get("/ping")
@@ -33,33 +80,221 @@ def run(host: str, port: int, model_manager: ModelManager, embed_manager: EmbedM
         return model_manager.list_models()
 
     @app.post("/models/{engine}/{model_name}")
-    def load_model(engine: str, model_name: str):
+    def load_model(
+        engine: str,
+        model_name: str,
+        wait: bool = False,
+        context_window: int | None = None,
+        draft_model: str | None = None,
+        draft_tokens: int | None = None,
+        ngram_draft: bool | None = None,
+    ):
+        # Loads in the background unless asked to wait, progress shows up
+        # under `loading` in /status
         try:
             engine_type = EngineType[engine]
-            model_manager.load_model(engine_type, model_name)
+            options = {
+                "context_window": context_window,
+                "draft_model": draft_model,
+                "draft_tokens": draft_tokens,
+                "ngram_draft": ngram_draft,
+            }
+            if wait:
+                model_manager.load_model(engine_type, model_name, options=options)
+            else:
+                model_manager.start_load(engine_type, model_name, options=options)
             return model_manager.model_status()
-        except ValueError as e:
+        except (KeyError, ValueError) as e:
             return {"error": str(e)}
 
     @app.get("/status")
     def status():
-        return model_manager.model_status()
+        return {
+            **model_manager.model_status(),
+            "embed": embed_manager.status() if embed_manager is not None else None,
+        }
+
+    @app.get("/metrics")
+    def prometheus_metrics():
+        return PlainTextResponse(
+            metrics.render(), media_type="text/plain; version=0.0.4"
+        )
 
-    @app.post("/embed")
-    def embed(req: TextRequest):
-        return { "embeddings": embed_manager.embed(req.text) }
+    if embed_manager is not None:
+        @app.post("/embed")
+        def embed(req: TextRequest):
+            return { "embeddings": embed_manager.embed(req.text) }
+
+        @app.post("/embed/batch")
+        def embed_batch(req: BatchTextRequest):
+            return { "embeddings": embed_manager.embed_batch(req.texts) }
 
     @app.delete("/models")
     def unload_model():
         model_manager.unload_model()
         return model_manager.model_status()
 
+    @app.delete("/models/{model_name}")
+    def unload_named_model(model_name: str):
+        model_manager.unload_model(model_name)
+        return model_manager.model_status()
+
+    def submit(http_request: HttpRequest, params: dict) -> QueueResponder:
+        # Runs the request through Request.handle like the socket server
+        # does, so it shares the scheduler, cancellation and engines
+        host = http_request.client.host if http_request.client else None
+        responder = QueueResponder(model_manager, f"http:{host}")
+        request = Request(f"cmpl-{uuid.uuid4().hex}", "complete", params)
+        responder.task = asyncio.create_task(request.handle(model_manager, responder))
+        return responder
+
+    async def results(responder: QueueResponder):
+        # Yields streamed chunks, then the final response
+        try:
+            while True:
+                final, response = await responder.queue.get()
+                if final or response.error is not None:
+                    yield response
+                    return
+                if response.result and response.result.get("status") == "ongoing":
+                    yield response
+        finally:
+            # The client went away or stopped reading
+            responder.disconnected()
+
+    def resident_model(name: str | None) -> str | None:
+        # OpenAI clients always send a model, only route it if we have it
+        return name if name in model_manager.models else None
+
+    def usage(result: dict) -> dict:
+        counts = result.get("usage") or {}
+        prompt_tokens = counts.get("prompt_tokens", 0)
+        completion_tokens = counts.get("completion_tokens", 0)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": counts.get("cached_tokens", 0)},
+        }
+
+    def finish_reason(result: dict) -> str:
+        # Engines report why they stopped in their own words
+        if result.get("stop_reason") in ("length", "max_new_tokens", "context"):
+            return "length"
+        return "stop"
+
     @app.post("/complete")
-    def complete(req: TextRequest):
-        engine = model_manager.current_engine()
-        if engine is None:
-            return {"error": "No model loaded"}
-        parameters = EngineParameters()
-        return {"completion": engine.complete(parameters, req.text)}
+    async def complete(req: TextRequest, http_request: HttpRequest):
+        responder = submit(
+            http_request,
+            {
+                "prompt": req.text,
+                "engine_parameters": json.dumps(req.engine_parameters or {}),
+            },
+        )
+        async for response in results(responder):
+            if response.error is not None:
+                return {"error": response.error}
+            if response.result and response.result.get("status") != "ongoing":
+                return {"completion": response.result["tokens"]}
+
+    async def openai_completion(http_request: HttpRequest, chat: bool):
+        body = await http_request.json()
+        model = resident_model(body.get("model"))
+        params = {
+            "engine_parameters": json.dumps(engine_parameters(body)),
+            "model": model,
+        }
+        if chat:
+            params["messages"] = body.get("messages", [])
+        else:
+            prompt = body.get("prompt", "")
+            if isinstance(prompt, list):
+                # A list holds separate prompts, only a single one is served
+                if len(prompt) != 1 or not isinstance(prompt[0], str):
+                    return JSONResponse(
+                        {"error": {"message": "Only a single prompt string is supported"}},
+                        400,
+                    )
+                prompt = prompt[0]
+            params["prompt"] = prompt
+        for option in ["flush_ms", "flush_tokens", "truncation", "preset"]:
+            if body.get(option) is not None:
+                params[option] = body[option]
+        responder = submit(http_request, params)
+        id = f"chatcmpl-{uuid.uuid4().hex}" if chat else f"cmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        # Report the model that serves the request, not one we don't have
+        name = model if model is not None else model_manager.default_model
+
+        def choice(text: str | None, finish_reason: str | None, delta: bool) -> dict:
+            if not chat:
+                return {
+                    "index": 0,
+                    "text": text or "",
+                    "logprobs": None,
+                    "finish_reason": finish_reason,
+                }
+            content = {} if text is None else {"role": "assistant", "content": text}
+            key = "delta" if delta else "message"
+            return {"index": 0, key: content, "finish_reason": finish_reason}
+
+        def chunk(text: str | None, finish_reason: str | None, delta: bool = True) -> dict:
+            if chat:
+                object = "chat.completion.chunk" if delta else "chat.completion"
+            else:
+                object = "text_completion"
+            return {
+                "id": id,
+                "object": object,
+                "created": created,
+                "model": name,
+                "choices": [choice(text, finish_reason, delta)],
+            }
+
+        if not body.get("stream"):
+            async for response in results(responder):
+                if response.error is not None:
+                    return JSONResponse({"error": {"message": response.error}}, 400)
+                if response.result and response.result.get("status") != "ongoing":
+                    return {
+                        **chunk(
+                            response.result.get("tokens", ""),
+                            finish_reason(response.result),
+                            delta=False,
+                        ),
+                        "usage": usage(response.result),
+                    }
+
+        async def events():
+            async for response in results(responder):
+                if response.error is not None:
+                    yield sse({"error": {"message": response.error}})
+                    break
+                if response.result.get("status") == "ongoing":  # type: ignore
+                    yield sse(chunk(response.result["tokens"], None))  # type: ignore
+                else:
+                    yield sse(chunk(None, finish_reason(response.result)))  # type: ignore
+            yield sse("[DONE]")
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/completions")
+    async def completions(http_request: HttpRequest):
+        return await openai_completion(http_request, chat=False)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(http_request: HttpRequest):
+        return await openai_completion(http_request, chat=True)
+
+    @app.get("/v1/models")
+    def openai_models():
+        return {
+            "object": "list",
+            "data": [
+                {"id": model["name"], "object": "model", "owned_by": "ullm"}
+                for model in model_manager.list_models()
+            ],
+        }
 
     uvicorn.run(app, host=host, port=port)
@@ -1,18 +1,91 @@
 def main():
     import cli
     args = cli.parse()
-    if not args.http and not args.sockets and not args.rabbitmq:
+    servers = args.http or args.sockets or args.rabbitmq
+    if not servers and not args.batch_input:
         print(f"Please specify at least one server type to start")
         return
 
     import data
     data_dir = data.DataDir(args.data_dir)
 
+    from engines.engine import EngineConfig
+    engine_config = EngineConfig(
+        max_batch_size=args.max_batch_size,
+        cache_tokens=args.cache_tokens,
+        prefix_cache_mb=args.prefix_cache_mb,
+        context_window=args.context_window,
+        threads=args.threads,
+        threads_batch=args.threads_batch,
+        batch_tokens=args.batch_tokens,
+        gpu_layers=args.gpu_layers,
+        mmap=args.mmap,
+        mlock=args.mlock,
+        draft_model=(
+            str(data_dir.get_model_path() / args.draft_model)
+            if args.draft_model
+            else None
+        ),
+        draft_tokens=args.draft_tokens,
+        ngram_draft=args.ngram_draft,
+    )
+
+    import scheduler
+    request_scheduler = scheduler.Scheduler(args.max_batch_size, args.max_queued)
+
     import models
-    model_manager = models.ModelManager(data_dir)
+    model_manager = models.ModelManager(
+        data_dir,
+        engine_config,
+        request_scheduler,
+        args.memory_budget_mb,
+        args.parked_timeout_sec,
+        args.unload_first,
+        args.session_memory_mb,
+    )
 
-    import embed
-    embed_manager = embed.EmbedManager()
+    if args.batch_input:
+        import asyncio
+        import batch
+        from pathlib import Path
+        if args.batch_model:
+            model_manager.load_model(
+                models.model_engine(data_dir.get_model_path() / args.batch_model),
+                args.batch_model,
+            )
+        input = Path(args.batch_input)
+        output = (
+            Path(args.batch_output)
+            if args.batch_output
+            else input.with_suffix(".out.jsonl")
+        )
+        try:
+            asyncio.run(
+                batch.run_file(
+                    model_manager,
+                    input,
+                    output,
+                    args.batch_concurrency or args.max_batch_size,
+                )
+            )
+        finally:
+            model_manager.unload_model()
+        return
+
+    embed_manager = None
+    if args.http and args.embed:
+        import embed
+        import embed_cache
+        embed_manager = embed.EmbedManager(
+            args.embed_batch_size,
+            args.embed_batch_wait_ms,
+            embed_cache.EmbeddingCache(
+                data_dir.get_embed_cache_path() / embed.MODEL_NAME.replace("/", "--"),
+                embed.MODEL_NAME,
+                args.embed_cache_items,
+            ),
+            args.embed_preload,
+        )
 
     if args.http:
         import http_server
@@ -22,7 +95,9 @@ def main():
                           embed_manager)
     if args.sockets:
         import sockets_server
-        sockets_server.start(args.host, args.sockets_port, model_manager)
+        sockets_server.start(
+            args.host, args.sockets_port, model_manager, args.sockets_max_in_flight
+        )
     if args.rabbitmq:
         import rabbitmq
         rabbitmq.start(
@@ -34,9 +109,17 @@ def main():
             args.rabbitmq_username,
             args.rabbitmq_password,
             model_manager,
+            args.rabbitmq_prefetch,
+            args.rabbitmq_heartbeat_sec,
+            args.rabbitmq_flush_ms,
+            args.rabbitmq_max_unconfirmed,
         )
-    import time
-    time.sleep(1)
+    # Stay alive with the servers, once the main thread exits the interpreter
+    # shuts down executors and `run_in_executor` starts failing
+    import threading
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
 
 
 if __name__ == "__main__":
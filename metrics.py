@@ -0,0 +1,218 @@
+import bisect
+import threading
+from typing import Callable
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+)
+LOAD_BUCKETS = (1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+# Minimal Prometheus style metrics, rendered in the text exposition format
+# by `render` and as plain dicts by `snapshot`. Label values are passed as
+# keyword arguments and must always use the same label names per metric.
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values: dict[tuple, object] = {}
+        METRICS.append(self)
+
+    @staticmethod
+    def key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def format_labels(key: tuple) -> str:
+        if not key:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in key) + "}"
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]  # type: ignore
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            lines.append(f"{name}{self.format_labels(key)} {format_value(value)}")
+        return "\n".join(lines)
+
+    def snapshot(self) -> list[dict]:
+        with self.lock:
+            return [
+                {"labels": dict(key), "value": value}
+                for key, value in self.values.items()
+            ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount  # type: ignore
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.function: Callable[[], float] | None = None
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        # Reads the value when metrics are collected instead of tracking it
+        self.function = function
+
+    def collect(self) -> None:
+        if self.function is not None:
+            self.set(self.function())
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        self.collect()
+        return super().samples()
+
+    def snapshot(self) -> list[dict]:
+        self.collect()
+        return super().snapshot()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # Per bucket counts, then sum and count
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1  # type: ignore
+            entry[1] += value  # type: ignore
+            entry[2] += 1  # type: ignore
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():  # type: ignore
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append(
+                        (f"{self.name}_bucket", key + (("le", format_value(bound)),), cumulative)
+                    )
+                samples.append((f"{self.name}_bucket", key + (("le", "+Inf"),), count))
+                samples.append((f"{self.name}_sum", key, total))
+                samples.append((f"{self.name}_count", key, count))
+        return samples
+
+    def snapshot(self) -> list[dict]:
+        with self.lock:
+            return [
+                {
+                    "labels": dict(key),
+                    "count": count,
+                    "sum": total,
+                    "buckets": {
+                        format_value(bound): count
+                        for bound, count in zip(self.buckets, counts)
+                    },
+                }
+                for key, (counts, total, count) in self.values.items()  # type: ignore
+            ]
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+METRICS: list[Metric] = []
+
+TIME_TO_FIRST_TOKEN = Histogram(
+    "ullm_time_to_first_token_seconds",
+    "Time from receiving a completion request to streaming its first token.",
+)
+INTER_TOKEN_LATENCY = Histogram(
+    "ullm_inter_token_latency_seconds",
+    "Time between consecutive streamed tokens of a completion.",
+)
+REQUEST_DURATION = Histogram(
+    "ullm_request_duration_seconds",
+    "Time from receiving a completion request to its final response.",
+)
+QUEUE_WAIT = Histogram(
+    "ullm_queue_wait_seconds",
+    "Time completions waited for a free slot in the scheduler.",
+)
+PROMPT_TOKENS = Counter(
+    "ullm_prompt_tokens_total",
+    "Prompt tokens processed by completions.",
+)
+CACHED_PROMPT_TOKENS = Counter(
+    "ullm_cached_prompt_tokens_total",
+    "Prompt tokens reused from the prefix cache.",
+)
+COMPLETION_TOKENS = Counter(
+    "ullm_completion_tokens_total",
+    "Tokens generated by completions.",
+)
+DRAFT_ACCEPTED_TOKENS = Counter(
+    "ullm_draft_accepted_tokens_total",
+    "Speculated tokens the model accepted.",
+)
+DRAFT_REJECTED_TOKENS = Counter(
+    "ullm_draft_rejected_tokens_total",
+    "Speculated tokens the model rejected.",
+)
+TOKENS_PER_SECOND = Gauge(
+    "ullm_tokens_per_second",
+    "Generation speed of the last completion, per model.",
+)
+QUEUE_DEPTH = Gauge(
+    "ullm_queue_depth",
+    "Completions waiting for a free slot.",
+)
+RUNNING_REQUESTS = Gauge(
+    "ullm_running_requests",
+    "Completions currently admitted to an engine.",
+)
+MODEL_LOAD_DURATION = Histogram(
+    "ullm_model_load_seconds",
+    "Time taken to load a model, including warmup.",
+    LOAD_BUCKETS,
+)
+EMBED_BATCH_SIZE = Histogram(
+    "ullm_embed_batch_size",
+    "Number of texts encoded per embedding forward pass.",
+    BATCH_BUCKETS,
+)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+
+def snapshot() -> dict:
+    return {metric.name: metric.snapshot() for metric in METRICS}
@@ -1,13 +1,21 @@
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
 from enum import Enum
+from pathlib import Path
+from typing import Callable
+import threading
 import time
 import json
 
-from exllamav2.generator.base import threading
-from engines.engine import Engine, EngineType
-from engines.exllamav2 import ExLlamaV2Engine
-# from engines.llama_cpp import LlamaCppEngine
+from engines.engine import Engine, EngineConfig, EngineType
+from engines.registry import engine_class
+from cancellation import CancellationRegistry
+import metrics
 from data import DataDir
+from parking import PageCacheHold
+from scheduler import Scheduler
+from presets import PresetStore
+from sessions import SessionManager
 
 
 class ModelStatus(Enum):
@@ -27,90 +35,482 @@ class SimpleModel:
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
 
 
+class ModelTier(Enum):
+    ACTIVE = "active"
+    PARKED = "parked"
+
+
+@dataclass
+class ResidentModel:
+    name: str
+    engine_type: EngineType
+    # None while parked
+    engine: Engine | None
+    footprint: int
+    timeout_sec: int
+    used: float
+    tier: ModelTier = ModelTier.ACTIVE
+    hold: PageCacheHold | None = None
+    # EngineConfig overrides the model was loaded with
+    options: dict = field(default_factory=dict)
+
+
+def model_footprint(path: Path) -> int:
+    # The weights on disk are a good estimate of what a model occupies once
+    # loaded, whether that's VRAM for exllamav2 or RAM for llama.cpp
+    if path.is_file():
+        return path.stat().st_size
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+# EngineConfig fields a load_model request may set for a single model
+LOAD_OPTIONS = ("context_window", "draft_model", "draft_tokens", "ngram_draft")
+
+
+def load_options(options: dict | None) -> dict:
+    options = {k: v for k, v in (options or {}).items() if v is not None}
+    unknown = set(options) - set(LOAD_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown load options: {', '.join(sorted(unknown))}")
+    return options
+
+
+def model_engine(path: Path) -> EngineType:
+    # GGUF files are llama.cpp models, directories hold exllamav2 weights
+    # unless they describe a simulated model
+    if path.is_file():
+        return EngineType.LLAMA_CPP
+    if (path / "simulated.json").exists():
+        return EngineType.SIMULATED
+    return EngineType.EXLLAMAV2
+
+
 class ModelManager:
-    def __init__(self, data_dir: DataDir):
+    def __init__(
+        self,
+        data_dir: DataDir,
+        engine_config: EngineConfig | None = None,
+        scheduler: Scheduler | None = None,
+        memory_budget_mb: int = 0,
+        parked_timeout_sec: int = 1800,
+        unload_first: bool = False,
+        session_memory_mb: int = 2048,
+    ):
         self.data_dir = data_dir
-        self.engine = None
-        self.engine_type = None
+        self.engine_config = (
+            engine_config if engine_config is not None else EngineConfig()
+        )
+        self.scheduler = (
+            scheduler
+            if scheduler is not None
+            else Scheduler(self.engine_config.max_batch_size)
+        )
+        self.cancellations = CancellationRegistry()
+        self.sessions = SessionManager(data_dir, session_memory_mb)
+        self.presets = PresetStore(data_dir)
+        metrics.QUEUE_DEPTH.set_function(lambda: self.scheduler.status()["queued"])
+        metrics.RUNNING_REQUESTS.set_function(
+            lambda: self.scheduler.status()["running"]
+        )
+        # 0 keeps a single model resident, like switching models always did
+        self.memory_budget = memory_budget_mb << 20
+        self.lock = threading.RLock()
+        # Least recently used first
+        self.models: OrderedDict[str, ResidentModel] = OrderedDict()
+        self.default_model: str | None = None
+        self.loading: dict[str, dict] = {}
         self.status = ModelStatus.NO_MODEL
-        self.model_name = None
-        self.timeout_sec = 300
+        self.last_error: str | None = None
+        self.drain_timeout_sec = 60
+        # Unloads the model being replaced before loading the new one, for
+        # GPUs that can't hold both while they're swapped
+        self.unload_first = unload_first
+        # Idle models are parked after their timeout and only released after
+        # this much more idle time, 0 releases them right away
+        self.parked_timeout_sec = parked_timeout_sec
+        self.reactivating: dict[str, threading.Event] = {}
         self.running = False
         self.timer_thread = None
-        self.used = time.time()
 
     def load_model(
-        self, engine: EngineType, model_name: str, timeout_sec: int = 300
+        self,
+        engine: EngineType,
+        model_name: str,
+        timeout_sec: int = 300,
+        progress: Callable[[dict], None] | None = None,
+        options: dict | None = None,
     ) -> None:
-        self.timeout_sec = timeout_sec
-        self.used = time.time()
+        options = load_options(options)
         list = self.list_models()
         if not any(d["name"] == model_name for d in list):
             raise ValueError(f"Model {model_name} not found")
-        if self.engine is not None:
-            self.engine.unload_model()
-        try:
+        with self.lock:
+            resident = self.models.get(model_name)
+            parked = False
+            if (
+                resident is not None
+                and resident.engine_type == engine
+                and all(resident.options.get(k) == v for k, v in options.items())
+            ):
+                resident.timeout_sec = timeout_sec
+                self.default_model = model_name
+                if resident.tier == ModelTier.ACTIVE:
+                    self.touch(resident)
+                    return
+                parked = True
+        if parked:
+            self.reactivate(model_name)
+            return
+        with self.lock:
+            if model_name in self.loading:
+                raise ValueError(f"Model {model_name} is already being loaded")
+            path = self.data_dir.get_model_path() / model_name
+            footprint = model_footprint(path)
+            if options.get("draft_model"):
+                footprint += model_footprint(
+                    self.data_dir.get_model_path() / options["draft_model"]
+                )
+            elif self.engine_config.draft_model is not None:
+                footprint += model_footprint(Path(self.engine_config.draft_model))
+            self.loading[model_name] = {"engine": engine.value, "stage": "starting"}
             self.status = ModelStatus.LOADING
-            self.engine_type = engine
-            self.engine = self.get_engine(
-                engine, self.data_dir.get_model_path() / model_name
+            evicted = self.make_room(model_name, footprint)
+        for resident in evicted:
+            self.drain(resident)
+
+        def report(update: dict):
+            if update.get("total"):
+                update = {
+                    **update,
+                    "bytes": footprint * update["loaded"] // update["total"],
+                    "total_bytes": footprint,
+                }
+            with self.lock:
+                self.loading[model_name] = {"engine": engine.value, **update}
+            if progress is not None:
+                progress(update)
+
+        # The model being swapped out, possibly an older copy of this one,
+        # keeps serving until the new engine has loaded and warmed up
+        started = time.monotonic()
+        try:
+            loaded = self.get_engine(engine, path, options)
+            loaded.load_model(report)
+        except Exception as e:
+            with self.lock:
+                self.loading.pop(model_name, None)
+                self.status = ModelStatus.ERROR
+                self.last_error = str(e)
+            raise e
+        metrics.MODEL_LOAD_DURATION.observe(
+            time.monotonic() - started, engine=engine.value, model=model_name
+        )
+        with self.lock:
+            self.loading.pop(model_name, None)
+            replaced = self.models.pop(model_name, None)
+            self.models[model_name] = ResidentModel(
+                model_name,
+                engine,
+                loaded,
+                footprint,
+                timeout_sec,
+                time.time(),
+                options=options,
             )
-            self.engine.load_model()
+            self.default_model = model_name
             self.status = ModelStatus.LOADED
-            self.model_name = model_name
+            self.last_error = None
+            retired = self.evict(model_name)
+            if replaced is not None:
+                retired.append(replaced)
             self.start_timer()
-        except Exception as e:
-            self.status = ModelStatus.ERROR
-            self.engine = None
-            self.model_name = None
-            raise e
+        for resident in retired:
+            self.retire(resident)
 
-    def unload_model(self) -> None:
-        print("Unloading model")
-        if self.timer_thread is not None:
-            self.running = False
-            self.timer_thread = None
-        if self.engine is not None:
-            self.engine.unload_model()
-            del self.engine
-            self.engine = None
-            self.status = ModelStatus.UNLOADED
-
-    def model_status(self) -> dict[str, str | None]:
-        status = self.status.value
-        engine_type = self.engine_type.value if self.engine_type is not None else None
-        return {"status": status, "engine": engine_type, "model": self.model_name}
-
-    def list_models(self) -> list[dict[str, str]]:
+    def start_load(
+        self,
+        engine: EngineType,
+        model_name: str,
+        timeout_sec: int = 300,
+        progress: Callable[[dict], None] | None = None,
+        options: dict | None = None,
+    ) -> threading.Thread:
+        options = load_options(options)
+        if not any(d["name"] == model_name for d in self.list_models()):
+            raise ValueError(f"Model {model_name} not found")
+
+        def load():
+            try:
+                self.load_model(
+                    engine, model_name, timeout_sec, progress, options
+                )
+            except Exception as e:
+                print(f"Failed to load model {model_name}: {str(e)}")
+
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        return thread
+
+    def evict(self, keep: str) -> list[ResidentModel]:
+        # Removes least recently used models until the active ones fit the
+        # budget, parked models only hold page cache and don't count
+        evicted = []
+        with self.lock:
+            while True:
+                active = [model for model in self.models.values() if model.engine]
+                if len(active) <= 1:
+                    break
+                used = sum(model.footprint for model in active)
+                if self.memory_budget > 0 and used <= self.memory_budget:
+                    break
+                name = next(model.name for model in active if model.name != keep)
+                print(f"Evicting least recently used model {name}")
+                evicted.append(self.models.pop(name))
+        return evicted
+
+    def make_room(self, model_name: str, footprint: int) -> list[ResidentModel]:
+        # Evicts active models before a load so that only the model being
+        # swapped out overlaps with the new one, idle ones go first
+        with self.lock:
+            swapping = set() if self.unload_first else {model_name, self.default_model}
+            active = [model for model in self.models.values() if model.engine]
+            candidates = sorted(
+                (model for model in active if model.name not in swapping),
+                key=lambda model: model.engine.active_requests() > 0,  # type: ignore
+            )
+            used = sum(
+                model.footprint for model in active if model.name not in swapping
+            )
+            evicted = []
+            for model in candidates:
+                if self.memory_budget > 0 and used + footprint <= self.memory_budget:
+                    break
+                print(f"Evicting model {model.name} to make room for {model_name}")
+                evicted.append(self.models.pop(model.name))
+                used -= model.footprint
+            if self.default_model not in self.models:
+                self.default_model = next(reversed(self.models), None)
+            return evicted
+
+    def drain(self, resident: ResidentModel) -> None:
+        # Waits for requests already running on the engine, then unloads it
+        deadline = time.time() + self.drain_timeout_sec
+        while resident.engine.active_requests() > 0 and time.time() < deadline:  # type: ignore
+            time.sleep(0.1)
+        print(f"Unloading model {resident.name}")
+        resident.engine.unload_model()  # type: ignore
+
+    def retire(self, resident: ResidentModel) -> None:
+        # Lets requests already running on a swapped out engine finish,
+        # parked models have none and only hold page cache
+        if resident.engine is None:
+            self.release(resident)
+            return
+        threading.Thread(target=self.drain, args=(resident,), daemon=True).start()
+
+    def unload_model(self, model_name: str | None = None) -> None:
+        with self.lock:
+            names = [*self.models] if model_name is None else [model_name]
+            removed = [self.models.pop(name) for name in names if name in self.models]
+            if self.default_model not in self.models:
+                self.default_model = next(reversed(self.models), None)
+            if not self.models:
+                self.running = False
+                self.timer_thread = None
+                if names:
+                    self.status = ModelStatus.UNLOADED
+        # Unloading takes a while, engine_for shouldn't wait on it
+        for resident in removed:
+            print(f"Unloading model {resident.name}")
+            self.release(resident)
+
+    def release(self, resident: ResidentModel) -> None:
+        if resident.engine is not None:
+            resident.engine.unload_model()
+            resident.engine = None
+        if resident.hold is not None:
+            resident.hold.release()
+            resident.hold = None
+
+    def park(self, resident: ResidentModel) -> None:
+        # Frees the engine but keeps the weights hot in the page cache
+        with self.lock:
+            if (
+                self.models.get(resident.name) is not resident
+                or resident.tier != ModelTier.ACTIVE
+                or time.time() - resident.used <= resident.timeout_sec
+                or (resident.engine and resident.engine.active_requests() > 0)
+            ):
+                return
+            engine, resident.engine = resident.engine, None
+            resident.tier = ModelTier.PARKED
+        print(f"Parking model {resident.name}")
+        if engine is not None:
+            engine.unload_model()
+        hold = PageCacheHold(self.data_dir.get_model_path() / resident.name)
+        with self.lock:
+            # It may have been reactivated or unloaded in the meantime
+            if (
+                self.models.get(resident.name) is resident
+                and resident.tier == ModelTier.PARKED
+                and resident.hold is None
+            ):
+                resident.hold = hold
+                return
+        hold.release()
+
+    def is_parked(self, model_name: str | None) -> bool:
+        with self.lock:
+            name = model_name if model_name is not None else self.default_model
+            resident = self.models.get(name)  # type: ignore
+            return resident is not None and resident.tier == ModelTier.PARKED
+
+    def reactivate(self, model_name: str | None) -> Engine | None:
+        with self.lock:
+            name = model_name if model_name is not None else self.default_model
+            resident = self.models.get(name)  # type: ignore
+            if resident is None or resident.tier != ModelTier.PARKED:
+                return self.engine_for(name)
+            waiting = self.reactivating.get(name)  # type: ignore
+            if waiting is None:
+                self.reactivating[name] = threading.Event()  # type: ignore
+        if waiting is not None:
+            waiting.wait()
+            return self.engine_for(name)
+        print(f"Reactivating parked model {name}")
+        try:
+            engine = self.get_engine(
+                resident.engine_type,
+                self.data_dir.get_model_path() / name,  # type: ignore
+                resident.options,
+            )
+            engine.load_model()
+        finally:
+            with self.lock:
+                self.reactivating.pop(name).set()  # type: ignore
+        with self.lock:
+            if self.models.get(name) is not resident:  # type: ignore
+                engine.unload_model()
+                return None
+            resident.engine = engine
+            resident.tier = ModelTier.ACTIVE
+            if resident.hold is not None:
+                resident.hold.release()
+                resident.hold = None
+            self.touch(resident)
+            retired = self.evict(resident.name)
+        for evicted in retired:
+            self.retire(evicted)
+        return engine
+
+    def model_status(self) -> dict:
+        with self.lock:
+            default = self.models.get(self.default_model)  # type: ignore
+            now = time.time()
+            return {
+                "status": self.status.value,
+                "engine": default.engine_type.value if default else None,
+                "model": default.name if default else None,
+                "error": self.last_error,
+                "queue": self.scheduler.status(),
+                "tier": default.tier.value if default else None,
+                "cache": default.engine.status() if default and default.engine else None,
+                "memory": {
+                    "used": sum(
+                        model.footprint for model in self.models.values() if model.engine
+                    ),
+                    "budget": self.memory_budget,
+                    "parked": sum(
+                        model.hold.size for model in self.models.values() if model.hold
+                    ),
+                },
+                "models": [
+                    {
+                        "model": model.name,
+                        "engine": model.engine_type.value,
+                        "footprint": model.footprint,
+                        "idle_sec": int(now - model.used),
+                        "tier": model.tier.value,
+                        "cache": model.engine.status() if model.engine else None,
+                    }
+                    for model in reversed(self.models.values())
+                ],
+                "loading": [
+                    {"model": name, **progress}
+                    for name, progress in self.loading.items()
+                ],
+            }
+
+    def list_models(self) -> list[dict]:
         model_path = self.data_dir.get_model_path()
-        return [{"engine": "llama-cpp", "name": f.name} for f in model_path.iterdir()]
+        with self.lock:
+            return [
+                {
+                    "engine": model_engine(f).value,
+                    "name": f.name,
+                    "resident": f.name in self.models,
+                    "footprint": model_footprint(f),
+                }
+                for f in model_path.iterdir()
+            ]
 
     def start_timer(self):
         if not self.running:
             self.running = True
-            self.used = time.time()
             self.timer_thread = threading.Thread(target=self.check_timeout)
             self.timer_thread.start()
 
     def check_timeout(self):
         while self.running:
             time.sleep(1)  # sleep for 1 second
-            since_used = time.time() - self.used
-            if since_used > self.timeout_sec:
-                print("Timeout reached, unloading model")
-                self.used = time.time()
-                self.unload_model()
-                break
+            now = time.time()
+            parking = []
+            unloading = []
+            with self.lock:
+                for model in [*self.models.values()]:
+                    if model.engine is not None and model.engine.active_requests() > 0:
+                        # Still generating, the idle time starts once it's done
+                        model.used = now
+                        continue
+                    idle = now - model.used
+                    if model.name in self.reactivating or idle <= model.timeout_sec:
+                        continue
+                    if model.tier == ModelTier.ACTIVE and self.parked_timeout_sec > 0:
+                        parking.append(model)
+                    elif idle > model.timeout_sec + self.parked_timeout_sec:
+                        unloading.append(model.name)
+            for model in parking:
+                self.park(model)
+            for name in unloading:
+                if self.is_parked(name) or self.parked_timeout_sec == 0:
+                    print(f"Timeout reached, unloading model {name}")
+                    self.unload_model(name)
+
+    def touch(self, resident: ResidentModel) -> None:
+        resident.used = time.time()
+        self.models.move_to_end(resident.name)
 
     def current_engine(self) -> Engine | None:
-        self.used = time.time()
-        return self.engine
+        return self.engine_for(None)
+
+    def engine_for(self, model_name: str | None) -> Engine | None:
+        # Routes to the named resident model, or the last loaded one
+        with self.lock:
+            name = model_name if model_name is not None else self.default_model
+            resident = self.models.get(name)  # type: ignore
+            if resident is None or resident.engine is None:
+                return None
+            self.touch(resident)
+            return resident.engine
 
-    def get_engine(self, engine: EngineType, path) -> Engine:
+    def get_engine(
+        self, engine: EngineType, path, options: dict | None = None
+    ) -> Engine:
         print(f"Loading model {engine} from {path}")
-        if engine == EngineType.EXLLAMAV2:
-            return ExLlamaV2Engine(path)
-        # if engine == EngineType.LLAMA_CPP:
-            # return LlamaCppEngine(path)
-        else:
-            raise NotImplementedError(f"Engine {engine} not implemented")
+        options = dict(options or {})
+        if options.get("draft_model"):
+            draft = self.data_dir.get_model_path() / options["draft_model"]
+            if not draft.exists():
+                raise ValueError(f"Draft model {options['draft_model']} not found")
+            options["draft_model"] = str(draft)
+        return engine_class(engine)(path, replace(self.engine_config, **options))
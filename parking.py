@@ -0,0 +1,32 @@
+import mmap
+import os
+from pathlib import Path
+
+# Files smaller than this (configs, tokenizers) aren't worth keeping mapped
+MIN_FILE_SIZE = 1 << 20
+
+
+# Keeps a model's weight files mapped and read ahead into the page cache while
+# its engine is unloaded, so reactivating it reads from memory, not disk.
+class PageCacheHold:
+    def __init__(self, path: Path):
+        self.maps: list[mmap.mmap] = []
+        self.size = 0
+        files = [path] if path.is_file() else sorted(path.rglob("*"))
+        for file in files:
+            if not file.is_file() or file.stat().st_size < MIN_FILE_SIZE:
+                continue
+            with open(file, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_WILLNEED)
+            elif hasattr(os, "posix_fadvise"):
+                with open(file, "rb") as f:
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            self.maps.append(mapped)
+            self.size += len(mapped)
+
+    def release(self) -> None:
+        for mapped in self.maps:
+            mapped.close()
+        self.maps.clear()
@@ -0,0 +1,80 @@
+import json
+import re
+import threading
+from dataclasses import asdict, replace
+
+from data import DataDir
+from engines.engine import EngineParameters
+
+PRESET_NAME = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+
+
+# Named sets of engine parameters kept in the data directory. Requests name
+# a preset and send only what they change, instead of every field. Presets
+# are parsed once and shared between requests, so they must not be mutated.
+class PresetStore:
+    def __init__(self, data_dir: DataDir):
+        self.path = data_dir.get_preset_path()
+        self.lock = threading.Lock()
+        self.presets: dict[str, EngineParameters] = {}
+        self.default = EngineParameters()
+
+    def get(self, name: str) -> EngineParameters:
+        with self.lock:
+            preset = self.presets.get(name)
+        if preset is not None:
+            return preset
+        if not PRESET_NAME.match(name) or not self.preset_path(name).exists():
+            raise ValueError(f"Unknown preset {name}")
+        preset = parse(json.loads(self.preset_path(name).read_text()))
+        with self.lock:
+            self.presets[name] = preset
+        return preset
+
+    def save(self, name: str, parameters: dict) -> EngineParameters:
+        if not PRESET_NAME.match(name):
+            raise ValueError(f"Invalid preset name {name}")
+        preset = parse(parameters)
+        self.preset_path(name).write_text(json.dumps(parameters, indent=4))
+        with self.lock:
+            self.presets[name] = preset
+        return preset
+
+    def delete(self, name: str) -> None:
+        if not PRESET_NAME.match(name) or not self.preset_path(name).exists():
+            raise ValueError(f"Unknown preset {name}")
+        self.preset_path(name).unlink()
+        with self.lock:
+            self.presets.pop(name, None)
+
+    def list(self) -> dict[str, dict]:
+        return {
+            path.stem: asdict(self.get(path.stem))
+            for path in sorted(self.path.glob("*.json"))
+        }
+
+    def resolve(
+        self, name: str | None, overrides: dict | str | None
+    ) -> EngineParameters:
+        # The preset, or the defaults, with the request's own parameters on top
+        parameters = self.get(name) if name is not None else self.default
+        if isinstance(overrides, str):
+            overrides = json.loads(overrides)
+        if not overrides:
+            return parameters
+        try:
+            return replace(parameters, **overrides)
+        except TypeError as e:
+            raise ValueError(f"Invalid engine parameters: {str(e)}")
+
+    def preset_path(self, name: str):
+        return self.path / f"{name}.json"
+
+
+def parse(parameters: dict) -> EngineParameters:
+    if not isinstance(parameters, dict):
+        raise ValueError("Engine parameters must be an object")
+    try:
+        return EngineParameters(**parameters)
+    except TypeError as e:
+        raise ValueError(f"Invalid engine parameters: {str(e)}")
@@ -1,10 +1,12 @@
 import asyncio
+import threading
+
 import pika
-import json
-import functools
+from pika.adapters.asyncio_connection import AsyncioConnection
 
 from models import ModelManager
 from request import IResponder, Request, Response
+from scheduler import Priority
 
 
 def start(
@@ -16,12 +18,27 @@ def start(
     username: str,
     password: str,
     model_manager: ModelManager,
+    prefetch: int = 16,
+    heartbeat_sec: int = 60,
+    flush_ms: float = 50,
+    max_unconfirmed: int = 1024,
 ):
-    import threading
-
     thread = threading.Thread(
         target=run,
-        args=(host, port, vhost, queue, reply_queue, username, password, model_manager),
+        args=(
+            host,
+            port,
+            vhost,
+            queue,
+            reply_queue,
+            username,
+            password,
+            model_manager,
+            prefetch,
+            heartbeat_sec,
+            flush_ms,
+            max_unconfirmed,
+        ),
     )
     thread.start()
 
@@ -35,74 +52,251 @@ def run(
     username: str,
     password: str,
     model_manager: ModelManager,
+    prefetch: int = 16,
+    heartbeat_sec: int = 60,
+    flush_ms: float = 50,
+    max_unconfirmed: int = 1024,
 ):
     print(
         f"Starting rabbitmq connection on `amqp://{host}:{port}{vhost}` with queue `{queue}` and reply queue `{reply_queue}`"
     )
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(
-            host, port, vhost, pika.PlainCredentials(username, password)
-        )
+    parameters = pika.ConnectionParameters(
+        host,
+        port,
+        vhost,
+        pika.PlainCredentials(username, password),
+        heartbeat=heartbeat_sec,
     )
-    callback_datad = functools.partial(
-        callback, model_manager=model_manager, reply_queue=reply_queue
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    consumer = Consumer(
+        loop,
+        parameters,
+        queue,
+        reply_queue,
+        model_manager,
+        prefetch,
+        flush_ms,
+        max_unconfirmed,
     )
-
-    sub = connection.channel()
-    sub.queue_declare(queue=queue)
-    sub.queue_declare(queue=reply_queue)
-    sub.basic_consume(queue, on_message_callback=callback_datad)
-
+    consumer.connect()
     try:
-        print("Starting consuming")
-        sub.start_consuming()
-        print("Consuming started")
+        loop.run_forever()
     except KeyboardInterrupt:
         print("Stopping consuming")
-        sub.stop_consuming()
-        print("Consuming stopped")
-    connection.close()
+        consumer.stop()
+        loop.run_forever()
     print("Connection closed")
 
 
-class RabbitMQResponder(IResponder):
-    def __init__(self, channel, reply_queue):
-        self.channel = channel
+# Consumes requests on the connection's own event loop. Every delivery is
+# handled as a task, so up to `prefetch` requests are in flight at once and
+# generation never blocks the loop that answers the broker's heartbeats.
+# Messages are acked once they've been handled, which keeps unfinished ones on
+# the broker if this node dies.
+class Consumer:
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        parameters: pika.ConnectionParameters,
+        queue: str,
+        reply_queue: str,
+        model_manager: ModelManager,
+        prefetch: int,
+        flush_ms: float,
+        max_unconfirmed: int,
+    ):
+        self.loop = loop
+        self.parameters = parameters
+        self.queue = queue
         self.reply_queue = reply_queue
+        self.model_manager = model_manager
+        self.prefetch = prefetch
+        self.flush_ms = flush_ms
+        self.max_unconfirmed = max_unconfirmed
+        self.requeue_delay_sec = 1
+        self.connection: AsyncioConnection | None = None
+        self.channel = None
+        self.stopping = False
+        self.tasks: set[asyncio.Task] = set()
+        # Delivery tags of published replies the broker hasn't confirmed yet
+        self.published = 0
+        self.unconfirmed: set[int] = set()
+        self.confirmed = asyncio.Event()
 
-    async def raw_response(self, response):
+    def connect(self) -> None:
+        self.connection = AsyncioConnection(
+            self.parameters,
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            on_close_callback=self.on_connection_closed,
+            custom_ioloop=self.loop,
+        )
+
+    def reconnect(self) -> None:
+        if not self.stopping:
+            print("Reconnecting to rabbitmq in 5 seconds")
+            self.loop.call_later(5, self.connect)
+
+    def stop(self) -> None:
+        self.stopping = True
+        if self.connection is not None and not self.connection.is_closed:
+            self.connection.close()
+        else:
+            self.loop.stop()
+
+    def on_connection_open(self, connection) -> None:
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_open_error(self, connection, error) -> None:
+        print(f"Failed to connect to rabbitmq: {str(error)}")
+        self.reconnect()
+
+    def on_connection_closed(self, connection, reason) -> None:
+        print(f"Rabbitmq connection closed: {str(reason)}")
+        self.channel = None
+        self.abandon()
+        if self.stopping:
+            self.loop.stop()
+        else:
+            self.reconnect()
+
+    def on_channel_open(self, channel) -> None:
+        self.channel = channel
+        self.published = 0
+        self.unconfirmed.clear()
+        self.confirmed.set()
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.add_on_cancel_callback(lambda _: self.abandon())
+        channel.confirm_delivery(self.on_delivery_confirmation)
+        channel.queue_declare(
+            queue=self.queue,
+            callback=lambda _: channel.queue_declare(
+                queue=self.reply_queue,
+                callback=lambda _: channel.basic_qos(
+                    prefetch_count=self.prefetch,
+                    callback=lambda _: self.on_ready(channel),
+                ),
+            ),
+        )
+
+    def on_ready(self, channel) -> None:
+        channel.basic_consume(self.queue, on_message_callback=self.on_message)
+        print(f"Consuming with a prefetch of {self.prefetch}")
+
+    def on_channel_closed(self, channel, reason) -> None:
+        print(f"Rabbitmq channel closed: {str(reason)}")
+        self.channel = None
+        self.abandon()
+        if self.connection is not None and not self.connection.is_closed:
+            self.connection.close()
+
+    def abandon(self) -> None:
+        # Unacked deliveries go back to the queue, stop generating for them
+        self.model_manager.cancellations.cancel_where(
+            lambda entry: isinstance(entry[2], RabbitMQResponder)
+            and entry[2].consumer is self
+        )
+        self.confirmed.set()
+
+    def on_delivery_confirmation(self, frame) -> None:
+        tag = frame.method.delivery_tag
+        if isinstance(frame.method, pika.spec.Basic.Nack):
+            print(f"Broker rejected reply {tag}")
+        if frame.method.multiple:
+            self.unconfirmed = {t for t in self.unconfirmed if t > tag}
+        else:
+            self.unconfirmed.discard(tag)
+        if len(self.unconfirmed) < self.max_unconfirmed:
+            self.confirmed.set()
+
+    async def publish(self, routing_key: str, body: str, properties) -> bool:
+        # Waits for the broker to catch up when too many replies are unconfirmed
+        while self.channel is not None and len(self.unconfirmed) >= self.max_unconfirmed:
+            self.confirmed.clear()
+            await self.confirmed.wait()
+        if self.channel is None or not self.channel.is_open:
+            return False
         self.channel.basic_publish(
-            exchange="", routing_key=self.reply_queue, body=response.toJSON()
+            exchange="", routing_key=routing_key, body=body, properties=properties
         )
+        self.published += 1
+        self.unconfirmed.add(self.published)
+        return True
 
-    async def response(self, response):
-        await self.raw_response(response)
+    def on_message(self, channel, method, properties, body) -> None:
+        task = self.loop.create_task(self.handle(channel, method, properties, body))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
 
-    async def intermediate_response(self, response):
-        await self.raw_response(response)
+    async def handle(self, channel, method, properties, body) -> None:
+        # Producers are told apart by app_id, user_id or reply_to. Without
+        # any of them each message counts as its own client, rather than all
+        # anonymous producers sharing one turn and one cancel scope
+        client = (
+            properties.app_id
+            or properties.user_id
+            or properties.reply_to
+            or f"{self.queue}#{properties.correlation_id or method.delivery_tag}"
+        )
+        responder = RabbitMQResponder(
+            self,
+            properties.reply_to or self.reply_queue,
+            properties.correlation_id,
+            client,
+            self.model_manager,
+        )
+        try:
+            request = Request.from_json(body)
+            if responder.correlation_id is None:
+                responder.correlation_id = request.id
+            await request.handle(self.model_manager, responder)
+        except Exception as e:
+            print(f"Error handling request: {str(e)}")
+            await Response.new_no_id_error(str(e)).send(responder)
+        if not channel.is_open:
+            return
+        if responder.rejected:
+            # Hand the job back to the broker once the queue had time to
+            # drain, instead of answering a bulk job with an error
+            await asyncio.sleep(self.requeue_delay_sec)
+            if channel.is_open:
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
+        channel.basic_ack(delivery_tag=method.delivery_tag)
 
 
-def sync(f):
-    @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        return asyncio.get_event_loop().run_until_complete(f(*args, **kwargs))
+class RabbitMQResponder(IResponder):
+    def __init__(self, consumer, reply_to, correlation_id, client, model_manager):
+        super().__init__(model_manager)
+        self.consumer = consumer
+        self.reply_to = reply_to
+        self.correlation_id = correlation_id
+        self.client = f"amqp:{client}"
+        self.priority = Priority.BULK
+        # Streamed chunks are batched into fewer, larger messages
+        self.flush_ms = consumer.flush_ms or None
+        self.rejected = False
 
-    return wrapper
+    async def raw_response(self, response):
+        properties = pika.BasicProperties(
+            content_type="application/json",
+            correlation_id=self.correlation_id,
+        )
+        try:
+            if not await self.consumer.publish(
+                self.reply_to, response.toJSON(), properties
+            ):
+                self.disconnected()
+        except pika.exceptions.AMQPError as e:
+            print(f"Failed to publish response: {str(e)}")
+            self.disconnected()
 
+    async def response(self, response):
+        await self.raw_response(response)
 
-@sync
-async def callback(channel, method, properties, body, model_manager, reply_queue):
-    print("Received message")
-    responder = RabbitMQResponder(channel, reply_queue)
-    try:
-        print(f"Handling request: {str(body)}")
-        request = Request.from_json(body)
-        print(f"Request: {request}")
-        await request.handle(model_manager, responder)
-        print("Request handled")
-    except Exception as e:
-        print(f"Error handling request: {str(e)}")
-        await Response.new_no_id_error(str(e)).send(responder)
-    channel.basic_ack(delivery_tag=method.delivery_tag)
+    async def intermediate_response(self, response):
+        await self.raw_response(response)
+
+    async def queue_full(self, response):
+        self.rejected = True
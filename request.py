@@ -1,8 +1,24 @@
+import asyncio
 import json
+import threading
+import time
 
+import metrics
+
+from coalesce import Coalescer
 from dataclasses import dataclass
-from engines.engine import Engine, EngineType, EngineParameters
-from models import ModelManager
+from engines.engine import (
+    CompletionStats,
+    Engine,
+    EngineType,
+    EngineParameters,
+    RequestCancelled,
+)
+from engines.worker import TokenBridge
+from models import LOAD_OPTIONS, ModelManager
+from scheduler import Priority, QueueFullError
+from sessions import Session
+from truncation import STRATEGIES, fit_prompt
 from typing import Optional, Union
 
 
@@ -36,51 +52,27 @@ class Request:
         try:
             match method:
                 case "complete":
-                    error = await self.param_gate(
-                        self.params, ["prompt", "engine_parameters"]
-                    )
-                    if error is not None:
-                        return await error.send(responder)
-
-                    prompt: str = self.params["prompt"]  # type: ignore
-                    engine_parameters: EngineParameters = EngineParameters.from_json(
-                        self.params["engine_parameters"]  # type: ignore
-                    )
-
-                    async def streaming_callback(tokens):
-                        response = Response.new_result(
-                            id, {"status": "ongoing", "tokens": tokens}
+                    return await self.complete(model_manager, responder)
+                case "cancel":
+                    if self.params is not None and "target" in self.params:
+                        cancelled = model_manager.cancellations.cancel(
+                            self.params["target"], responder.client
                         )
-                        await responder.intermediate_response(response)
-
-                    current_engine = model_manager.current_engine()
-                    if current_engine is None:
-                        return await Response.new_error(id, "No model loaded").send(
-                            responder
+                    else:
+                        cancelled = model_manager.cancellations.cancel_client(
+                            responder.client
                         )
-                    final = await current_engine.complete_streaming(
-                        engine_parameters,
-                        prompt,
-                        streaming_callback,
-                    )
                     return await Response.new_result(
-                        id, {"status": "final", "tokens": final}
+                        id, {"status": "cancelled", "cancelled": cancelled}
                     ).send(responder)
-                case "cancel":
-                    current_engine = model_manager.current_engine()
-                    if current_engine is not None:
-                        current_engine.cancel_streaming()
-                        return await Response.new_result(
-                            id, {"status": "cancelled"}
-                        ).send(responder)
-                    else:
-                        return await Response.new_result(
-                            id, {"status": "unloaded"}
-                        ).send(responder)
                 case "ping":
                     return await Response.new_result(id, {"status": "pong"}).send(
                         responder
                     )
+                case "metrics":
+                    return await Response.new_result(id, metrics.snapshot()).send(
+                        responder
+                    )
                 case "status":
                     print("status")
                     return await Response.new_result(
@@ -94,7 +86,9 @@ class Request:
                     await responder.intermediate_response(
                         Response.new_result(id, model_manager.model_status())
                     )
-                    model_manager.unload_model()
+                    model_manager.unload_model(
+                        self.params.get("model") if self.params else None
+                    )
                     return await Response.new_result(
                         id, model_manager.model_status()
                     ).send(responder)
@@ -102,38 +96,169 @@ class Request:
                     error = await self.param_gate(self.params, ["engine", "model"])
                     if error is not None:
                         return await error.send(responder)
+                    engine = EngineType.from_str(self.params["engine"])  # type: ignore
+                    model = self.params["model"]  # type: ignore
                     await responder.intermediate_response(
                         Response.new_result(
                             id,
                             {
-                                "status": "unloading",
-                                "model": model_manager.model_status().get("model"),
-                                "engine": model_manager.model_status().get("engine"),
+                                "status": "loading",
+                                "model": model,
+                                "engine": engine.value,
                             },
                         )
                     )
-                    model_manager.unload_model()
-                    await responder.intermediate_response(
-                        Response.new_result(
-                            id,
-                            model_manager.model_status(),
+                    # The load runs on its own thread and carries on even if
+                    # this client goes away, progress is relayed as it comes in
+                    bridge = TokenBridge()
+
+                    def load():
+                        try:
+                            model_manager.load_model(
+                                engine,
+                                model,
+                                self.params.get("timeout_sec", 300),  # type: ignore
+                                bridge.put,
+                                {
+                                    key: self.params[key]  # type: ignore
+                                    for key in LOAD_OPTIONS
+                                    if key in self.params  # type: ignore
+                                },
+                            )
+                        except BaseException as e:
+                            bridge.fail(e)
+                        else:
+                            bridge.done()
+
+                    threading.Thread(target=load, daemon=True).start()
+                    async for progress in bridge:
+                        await responder.intermediate_response(
+                            Response.new_result(
+                                id,
+                                {
+                                    "status": "loading",
+                                    "model": model,
+                                    "engine": engine.value,
+                                    "progress": progress,
+                                },
+                            )
                         )
+                    return await Response.new_result(
+                        id, model_manager.model_status()
+                    ).send(responder)
+                case "complete_batch":
+                    error = await self.param_gate(self.params, ["requests"])
+                    if error is not None:
+                        return await error.send(responder)
+                    import batch
+
+                    async def completed(request: Request, response: Response):
+                        await responder.intermediate_response(
+                            Response.new_result(
+                                id,
+                                {
+                                    "status": "completed",
+                                    "request": request.id,
+                                    "result": response.result,
+                                    "error": response.error,
+                                },
+                            )
+                        )
+
+                    requests = [
+                        Request(**{"id": f"{id}-{number}", **request})
+                        for number, request in enumerate(self.params["requests"])  # type: ignore
+                    ]
+                    summary = await batch.run(
+                        model_manager,
+                        requests,
+                        completed,
+                        self.params.get(  # type: ignore
+                            "concurrency", model_manager.scheduler.max_running
+                        ),
+                        responder.client,
+                        responder,
                     )
-                    await responder.intermediate_response(
-                        Response.new_result(
-                            id,
-                            {
-                                "status": "loading",
-                                "model": self.params["model"],  # type: ignore
-                                "engine": self.params["engine"],  # type: ignore
-                            },
+                    return await Response.new_result(
+                        id, {"status": "final", **summary}
+                    ).send(responder)
+                case "save_preset":
+                    error = await self.param_gate(
+                        self.params, ["name", "engine_parameters"]
+                    )
+                    if error is not None:
+                        return await error.send(responder)
+                    parameters = self.params["engine_parameters"]  # type: ignore
+                    if isinstance(parameters, str):
+                        parameters = json.loads(parameters)
+                    model_manager.presets.save(self.params["name"], parameters)  # type: ignore
+                    return await Response.new_result(
+                        id, {"status": "saved", "name": self.params["name"]}  # type: ignore
+                    ).send(responder)
+                case "delete_preset":
+                    error = await self.param_gate(self.params, ["name"])
+                    if error is not None:
+                        return await error.send(responder)
+                    model_manager.presets.delete(self.params["name"])  # type: ignore
+                    return await Response.new_result(
+                        id, {"status": "deleted", "name": self.params["name"]}  # type: ignore
+                    ).send(responder)
+                case "list_presets":
+                    return await Response.new_result(
+                        id, {"presets": model_manager.presets.list()}
+                    ).send(responder)
+                case "open_session":
+                    params = self.params or {}
+                    session = model_manager.sessions.open(params.get("model"))
+                    if "text" in params or "messages" in params:
+                        model_manager.sessions.append(
+                            session.id, params.get("text"), params.get("messages")
                         )
+                    return await Response.new_result(
+                        id, {"status": "opened", **session.status()}
+                    ).send(responder)
+                case "append":
+                    error = await self.param_gate(self.params, ["session"])
+                    if error is not None:
+                        return await error.send(responder)
+                    session = model_manager.sessions.append(
+                        self.params["session"],  # type: ignore
+                        self.params.get("text"),  # type: ignore
+                        self.params.get("messages"),  # type: ignore
                     )
-                    engine = EngineType.from_str(self.params["engine"])  # type: ignore
-                    model = self.params["model"]  # type: ignore
-                    model_manager.load_model(engine, model)
                     return await Response.new_result(
-                        id, model_manager.model_status()
+                        id, {"status": "appended", **session.status()}
+                    ).send(responder)
+                case "close_session":
+                    error = await self.param_gate(self.params, ["session"])
+                    if error is not None:
+                        return await error.send(responder)
+                    model_manager.sessions.close(self.params["session"])  # type: ignore
+                    return await Response.new_result(
+                        id, {"status": "closed", "session": self.params["session"]}  # type: ignore
+                    ).send(responder)
+                case "snapshot_session":
+                    error = await self.param_gate(self.params, ["session"])
+                    if error is not None:
+                        return await error.send(responder)
+                    name = await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        model_manager.sessions.snapshot,
+                        self.params["session"],  # type: ignore
+                        self.params.get("name"),  # type: ignore
+                    )
+                    return await Response.new_result(
+                        id, {"status": "saved", "name": name}
+                    ).send(responder)
+                case "restore_session":
+                    error = await self.param_gate(self.params, ["name"])
+                    if error is not None:
+                        return await error.send(responder)
+                    session = await asyncio.get_running_loop().run_in_executor(
+                        None, model_manager.sessions.restore, self.params["name"]  # type: ignore
+                    )
+                    return await Response.new_result(
+                        id, {"status": "restored", **session.status()}
                     ).send(responder)
                 case _:
                     return await Response.new_error(id, "Unknown method").send(
@@ -142,12 +267,226 @@ class Request:
         except Exception as e:
             return await Response.new_error(id, str(e)).send(responder)
 
+    async def complete(
+        self, model_manager: ModelManager, responder: "IResponder"
+    ) -> "Response":
+        if self.params is None or self.params.get("session") is None:
+            return await self.generate(model_manager, responder)
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(
+            None, model_manager.sessions.acquire, self.params["session"]
+        )
+        try:
+            return await self.generate(model_manager, responder, session)
+        finally:
+            model_manager.sessions.release(session)
+            loop.run_in_executor(None, model_manager.sessions.evict)
+
+    async def generate(
+        self,
+        model_manager: ModelManager,
+        responder: "IResponder",
+        session: Session | None = None,
+    ) -> "Response":
+        id: str = self.id  # type: ignore
+        started = time.monotonic()
+        error = await self.param_gate(self.params, [])
+        if error is not None:
+            return await error.send(responder)
+        if (
+            session is None
+            and "prompt" not in self.params  # type: ignore
+            and "messages" not in self.params  # type: ignore
+        ):
+            return await Response.new_error(id, "No `prompt` provided").send(
+                responder
+            )
+
+        # Chat messages are rendered with the serving model's template once
+        # it's known, so whole turns can be dropped to fit its window
+        prompt: str | None = self.params.get("prompt")  # type: ignore
+        messages: list[dict] | None = self.params.get("messages")  # type: ignore
+        truncation: str = self.params.get("truncation", "error")  # type: ignore
+        if session is not None:
+            # Only the new part is sent, the rest is the session's history
+            prompt, messages = session.extended(prompt, messages)
+        if truncation not in STRATEGIES:
+            return await Response.new_error(
+                id, f"`truncation` must be one of {', '.join(STRATEGIES)}"
+            ).send(responder)
+        engine_parameters: EngineParameters = model_manager.presets.resolve(
+            self.params.get("preset"),  # type: ignore
+            self.params.get("engine_parameters"),  # type: ignore
+        )
+
+        stats = CompletionStats()
+        if self.params.get("token_ids"):  # type: ignore
+            stats.token_ids = []
+        sent_ids = 0
+
+        async def streaming_callback(tokens):
+            nonlocal sent_ids
+            result = {"status": "ongoing", "tokens": tokens}
+            if stats.token_ids is not None:
+                # Ids of the tokens generated since the last chunk
+                result["token_ids"] = stats.token_ids[sent_ids:]
+                sent_ids = len(stats.token_ids)
+            await responder.intermediate_response(Response.new_result(id, result))
+
+        flush_ms = self.params.get("flush_ms", responder.flush_ms)  # type: ignore
+        flush_tokens = self.params.get("flush_tokens", responder.flush_tokens)  # type: ignore
+        if flush_ms is not None and (
+            isinstance(flush_ms, bool)
+            or not isinstance(flush_ms, (int, float))
+            or flush_ms < 0
+        ):
+            return await Response.new_error(
+                id, "`flush_ms` must be a non-negative number"
+            ).send(responder)
+        if flush_tokens is not None and (
+            isinstance(flush_tokens, bool)
+            or not isinstance(flush_tokens, int)
+            or flush_tokens < 1
+        ):
+            return await Response.new_error(
+                id, "`flush_tokens` must be a positive integer"
+            ).send(responder)
+        coalescer = Coalescer(streaming_callback, flush_ms, flush_tokens)
+
+        model: str | None = self.params.get("model")  # type: ignore
+        if session is not None and session.model is not None:
+            if model not in (None, session.model):
+                return await Response.new_error(
+                    id, f"Session belongs to model {session.model}"
+                ).send(responder)
+            model = session.model
+        last_token: float | None = None
+
+        async def timed_push(chunk):
+            nonlocal last_token
+            now = time.monotonic()
+            if last_token is None:
+                metrics.TIME_TO_FIRST_TOKEN.observe(now - started, model=model_name)
+            else:
+                metrics.INTER_TOKEN_LATENCY.observe(now - last_token, model=model_name)
+            last_token = now
+            await coalescer.push(chunk)
+
+        async def queue_callback(position):
+            response = Response.new_result(
+                id, {"status": "queued", "position": position}
+            )
+            await responder.intermediate_response(response)
+
+        no_model = f"Model {model} not loaded" if model else "No model loaded"
+        if model_manager.engine_for(model) is None and model_manager.is_parked(model):
+            await responder.intermediate_response(
+                Response.new_result(id, {"status": "reactivating", "model": model})
+            )
+            await asyncio.get_running_loop().run_in_executor(
+                None, model_manager.reactivate, model
+            )
+        if model_manager.engine_for(model) is None:
+            return await Response.new_error(id, no_model).send(responder)
+        model_name = model if model is not None else model_manager.default_model
+        priority = responder.priority
+        if "priority" in self.params:  # type: ignore
+            requested = Priority.from_str(self.params["priority"])  # type: ignore
+            # Clients may only lower the priority of their transport
+            if requested.value > priority.value:
+                priority = requested
+        cancel = model_manager.cancellations.register(id, responder.client, responder)
+        try:
+            queued = time.monotonic()
+            async with model_manager.scheduler.slot(
+                responder.client, priority, queue_callback, cancel
+            ):
+                admitted = time.monotonic()
+                metrics.QUEUE_WAIT.observe(
+                    admitted - queued, priority=priority.name.lower()
+                )
+                current_engine = model_manager.engine_for(model)
+                if current_engine is None:
+                    return await Response.new_error(id, no_model).send(responder)
+                fitted, engine_parameters, truncated = (
+                    await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        fit_prompt,
+                        current_engine,
+                        engine_parameters,
+                        prompt,
+                        messages,
+                        truncation,
+                    )
+                )
+                try:
+                    final = await current_engine.complete_streaming(
+                        engine_parameters,
+                        fitted,
+                        timed_push,
+                        cancel,
+                        stats,
+                        session.kv if session is not None else None,
+                    )
+                finally:
+                    await coalescer.close()
+                if session is not None:
+                    session.record(prompt, messages, final)
+                    session.model = model_name
+                record_usage(model_name, stats, time.monotonic() - admitted)
+        except QueueFullError as e:
+            response = Response.new_error(id, str(e))
+            await responder.queue_full(response)
+            return response
+        except RequestCancelled:
+            metrics.REQUEST_DURATION.observe(
+                time.monotonic() - started, model=model_name, status="cancelled"
+            )
+            return await Response.new_result(
+                id, {"status": "cancelled", "tokens": ""}
+            ).send(responder)
+        finally:
+            model_manager.cancellations.unregister(cancel)
+        status = "cancelled" if cancel.cancelled else "final"
+        metrics.REQUEST_DURATION.observe(
+            time.monotonic() - started, model=model_name, status=status
+        )
+        result = {"status": status, "tokens": final, "stop_reason": stats.stop_reason}
+        result["usage"] = {
+            "prompt_tokens": stats.prompt_tokens,
+            "cached_tokens": stats.cached_tokens,
+            "completion_tokens": stats.completion_tokens,
+        }
+        if stats.token_ids is not None:
+            result["token_ids"] = stats.token_ids
+        if session is not None:
+            result["session"] = session.id
+        if truncated:
+            result["truncated"] = truncated
+        if stats.context_shifts:
+            result["context_shifts"] = stats.context_shifts
+        draft = stats.draft()
+        if draft is not None:
+            result["draft"] = draft
+        return await Response.new_result(id, result).send(responder)
+
     @staticmethod
     def from_json(input) -> "Request":
         data = json.loads(input)
         return Request(**data)
 
 
+def record_usage(model: str | None, stats: CompletionStats, elapsed: float) -> None:
+    metrics.PROMPT_TOKENS.inc(stats.prompt_tokens, model=model)
+    metrics.CACHED_PROMPT_TOKENS.inc(stats.cached_tokens, model=model)
+    metrics.COMPLETION_TOKENS.inc(stats.completion_tokens, model=model)
+    if stats.draft_accepted or stats.draft_rejected:
+        metrics.DRAFT_ACCEPTED_TOKENS.inc(stats.draft_accepted, model=model)
+        metrics.DRAFT_REJECTED_TOKENS.inc(stats.draft_rejected, model=model)
+    if elapsed > 0 and stats.completion_tokens:
+        metrics.TOKENS_PER_SECOND.set(stats.completion_tokens / elapsed, model=model)
+
+
 @dataclass
 class Response:
     id: Optional[str] = None
@@ -175,12 +514,21 @@ class Response:
     def new_error(id: str, error: str) -> "Response":
         return Response(id, None, error)
 
+    def to_dict(self) -> dict:
+        return {"id": self.id, "result": self.result, "error": self.error}
+
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+        return json.dumps(self.to_dict())
 
 
 class IResponder:
     model_manager: ModelManager
+    client: str = "anonymous"
+    priority: Priority = Priority.DEFAULT
+    # Defaults for requests that don't set their own
+    flush_ms: float | None = None
+    flush_tokens: int | None = None
+    closed: bool = False
 
     def __init__(self, model_manager: ModelManager):
         self.model_manager = model_manager
@@ -190,3 +538,16 @@ class IResponder:
 
     async def response(self, response: Response):
         pass
+
+    async def queue_full(self, response: Response):
+        # The scheduler turned the request away, transports that can retry
+        # it later may do that instead of replying
+        await self.response(response)
+
+    def disconnected(self):
+        # Stops everything still generating for a client that went away,
+        # including requests of its batches
+        self.closed = True
+        self.model_manager.cancellations.cancel_where(
+            lambda entry: entry[2] is self or getattr(entry[2], "parent", None) is self
+        )
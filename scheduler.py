@@ -0,0 +1,188 @@
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from enum import Enum
+from typing import Awaitable, Callable
+
+from engines.engine import CancellationToken, RequestCancelled
+
+
+class Priority(Enum):
+    INTERACTIVE = 0
+    DEFAULT = 1
+    BULK = 2
+
+    @staticmethod
+    def from_str(s: str) -> "Priority":
+        for priority in Priority:
+            if priority.name.lower() == s.lower():
+                return priority
+        raise ValueError(f"Unknown priority: {s}")
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, client: str, priority: Priority):
+        self.client = client
+        self.priority = priority
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+        self.granted = False
+
+    def wake(self) -> None:
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+# Admits at most `max_running` completions to the engine at once and queues up
+# to `max_queued` more. Higher priority classes always go first, within a class
+# clients are served round-robin so one producer can't starve the others.
+class Scheduler:
+    def __init__(self, max_running: int = 8, max_queued: int = 64):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.running = 0
+        self.queued = 0
+        self.queues: dict[Priority, OrderedDict[str, deque[Ticket]]] = {
+            priority: OrderedDict() for priority in Priority
+        }
+
+    def status(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "running": self.running,
+                "queued": self.queued,
+                "max_running": self.max_running,
+                "max_queued": self.max_queued,
+            }
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        client: str,
+        priority: Priority = Priority.DEFAULT,
+        on_position: Callable[[int], Awaitable[None]] | None = None,
+        cancel: CancellationToken | None = None,
+    ):
+        ticket = await self.acquire(client, priority, on_position, cancel)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    async def acquire(
+        self,
+        client: str,
+        priority: Priority = Priority.DEFAULT,
+        on_position: Callable[[int], Awaitable[None]] | None = None,
+        cancel: CancellationToken | None = None,
+    ) -> Ticket:
+        ticket = Ticket(client, priority)
+        if cancel is not None and cancel.cancelled:
+            raise RequestCancelled()
+        with self.lock:
+            if self.running < self.max_running and self.queued == 0:
+                self.running += 1
+                ticket.granted = True
+                return ticket
+            if self.queued >= self.max_queued:
+                raise QueueFullError("Queue full, try again later")
+            self.queues[priority].setdefault(client, deque()).append(ticket)
+            self.queued += 1
+        if cancel is not None:
+            cancel.on_cancel(ticket.wake)
+        last_position = None
+        try:
+            while True:
+                with self.lock:
+                    if ticket.granted:
+                        return ticket
+                    position = self.position(ticket)
+                if cancel is not None and cancel.cancelled:
+                    raise RequestCancelled()
+                if on_position is not None and position != last_position:
+                    last_position = position
+                    await on_position(position)
+                await ticket.event.wait()
+                ticket.event.clear()
+        except BaseException:
+            with self.lock:
+                if ticket.granted:
+                    self.release_locked()
+                else:
+                    self.remove(ticket)
+            raise
+
+    def release(self, ticket: Ticket) -> None:
+        with self.lock:
+            if ticket.granted:
+                ticket.granted = False
+                self.release_locked()
+
+    def release_locked(self) -> None:
+        self.running -= 1
+        self.admit()
+
+    def admit(self) -> None:
+        changed = False
+        while self.running < self.max_running:
+            ticket = self.next_ticket()
+            if ticket is None:
+                break
+            self.running += 1
+            ticket.granted = True
+            ticket.wake()
+            changed = True
+        if changed:
+            self.notify_waiting()
+
+    def next_ticket(self) -> Ticket | None:
+        for priority in Priority:
+            clients = self.queues[priority]
+            if not clients:
+                continue
+            client, tickets = next(iter(clients.items()))
+            ticket = tickets.popleft()
+            del clients[client]
+            if tickets:
+                clients[client] = tickets
+            self.queued -= 1
+            return ticket
+        return None
+
+    def remove(self, ticket: Ticket) -> None:
+        tickets = self.queues[ticket.priority].get(ticket.client)
+        if tickets is None or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        if not tickets:
+            del self.queues[ticket.priority][ticket.client]
+        self.queued -= 1
+        self.notify_waiting()
+
+    def notify_waiting(self) -> None:
+        for clients in self.queues.values():
+            for tickets in clients.values():
+                for ticket in tickets:
+                    ticket.wake()
+
+    def position(self, ticket: Ticket) -> int:
+        # Replays the round-robin admission order to find the ticket's turn
+        position = 0
+        for priority in Priority:
+            clients = [list(tickets) for tickets in self.queues[priority].values()]
+            if priority != ticket.priority:
+                position += sum(len(tickets) for tickets in clients)
+                continue
+            for depth in range(max(len(tickets) for tickets in clients)):
+                for tickets in clients:
+                    if depth >= len(tickets):
+                        continue
+                    position += 1
+                    if tickets[depth] is ticket:
+                        return position
+        return position
@@ -0,0 +1,213 @@
+import pickle
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from data import DataDir
+from engines.engine import SessionState
+
+SNAPSHOT_NAME = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+
+
+@dataclass
+class Session:
+    id: str
+    model: str | None
+    # Raw text sessions grow `text`, chat sessions grow `messages`
+    text: str = ""
+    messages: list[dict] | None = None
+    kv: SessionState = field(default_factory=SessionState)
+    # The KV snapshot was evicted to disk
+    evicted: bool = False
+    busy: bool = False
+    used: float = field(default_factory=time.time)
+
+    def extended(
+        self, text: str | None = None, messages: list[dict] | None = None
+    ) -> tuple[str | None, list[dict] | None]:
+        # The history with `text` or `messages` added, as prompt or messages
+        if messages is not None and self.text:
+            raise ValueError("Can't add messages to a text session")
+        if text is not None and self.messages is not None:
+            raise ValueError("Can't add text to a chat session")
+        if messages is not None or self.messages is not None:
+            return None, (self.messages or []) + (messages or [])
+        return self.text + (text or ""), None
+
+    def record(
+        self, prompt: str | None, messages: list[dict] | None, completion: str
+    ) -> None:
+        if messages is not None:
+            self.messages = messages + [{"role": "assistant", "content": completion}]
+        else:
+            self.text = (prompt or "") + completion
+
+    def status(self) -> dict:
+        return {
+            "session": self.id,
+            "model": self.model,
+            "messages": len(self.messages) if self.messages is not None else None,
+            "characters": len(self.text),
+            "kv_bytes": self.kv.size,
+            "evicted": self.evicted,
+        }
+
+
+# Keeps conversations on the server so clients only send what's new. Each
+# session holds its history and the engine's KV snapshot for it. Snapshots
+# of idle sessions are written under DataDir once they use more memory than
+# the budget, and read back when the session is next used.
+class SessionManager:
+    def __init__(self, data_dir: DataDir, memory_budget_mb: int = 2048):
+        self.path = data_dir.get_session_path()
+        self.memory_budget = memory_budget_mb << 20
+        self.lock = threading.Lock()
+        # Least recently used first
+        self.sessions: OrderedDict[str, Session] = OrderedDict()
+
+    def open(self, model: str | None) -> Session:
+        session = Session(uuid.uuid4().hex, model)
+        with self.lock:
+            self.sessions[session.id] = session
+        return session
+
+    def get(self, id: str) -> Session:
+        with self.lock:
+            session = self.sessions.get(id)
+        if session is None:
+            raise ValueError(f"Unknown session {id}")
+        return session
+
+    def append(
+        self, id: str, text: str | None = None, messages: list[dict] | None = None
+    ) -> Session:
+        with self.lock:
+            session = self.sessions.get(id)
+            if session is None:
+                raise ValueError(f"Unknown session {id}")
+            if session.busy:
+                raise ValueError(f"Session {id} is busy")
+            prompt, messages = session.extended(text, messages)
+            if messages is not None:
+                session.messages = messages
+            else:
+                session.text = prompt or ""
+            session.used = time.time()
+        return session
+
+    def close(self, id: str) -> None:
+        with self.lock:
+            session = self.sessions.get(id)
+            if session is None:
+                raise ValueError(f"Unknown session {id}")
+            if session.busy:
+                raise ValueError(f"Session {id} is busy")
+            del self.sessions[id]
+        self.kv_path(id).unlink(missing_ok=True)
+
+    def acquire(self, id: str) -> Session:
+        # Blocks on disk when the snapshot was evicted, run it off the loop
+        with self.lock:
+            session = self.sessions.get(id)
+            if session is None:
+                raise ValueError(f"Unknown session {id}")
+            if session.busy:
+                raise ValueError(f"Session {id} is busy")
+            session.busy = True
+            self.sessions.move_to_end(id)
+        if session.evicted:
+            try:
+                with open(self.kv_path(id), "rb") as f:
+                    session.kv = pickle.load(f)
+            except OSError as e:
+                # Costs a prefill, not the conversation
+                print(f"Failed to read session {id}: {str(e)}")
+                session.kv = SessionState()
+            session.evicted = False
+            self.kv_path(id).unlink(missing_ok=True)
+        return session
+
+    def release(self, session: Session) -> None:
+        # Eviction writes to disk, callers on the event loop run `evict`
+        # separately
+        with self.lock:
+            session.busy = False
+            session.used = time.time()
+
+    def evict(self) -> None:
+        with self.lock:
+            used = sum(session.kv.size for session in self.sessions.values())
+            evict = []
+            for session in self.sessions.values():
+                if used <= self.memory_budget:
+                    break
+                if session.busy or session.kv.state is None:
+                    continue
+                # Marked busy so nobody uses it while it's written out
+                session.busy = True
+                used -= session.kv.size
+                evict.append(session)
+        for session in evict:
+            print(f"Evicting session {session.id} to disk")
+            try:
+                with open(self.kv_path(session.id), "wb") as f:
+                    pickle.dump(session.kv, f)
+            except OSError as e:
+                print(f"Failed to write session {session.id}: {str(e)}")
+                session.kv = SessionState()
+            else:
+                session.kv = SessionState()
+                session.evicted = True
+            with self.lock:
+                session.busy = False
+
+    def snapshot(self, id: str, name: str | None = None) -> str:
+        name = name if name is not None else id
+        if not SNAPSHOT_NAME.match(name):
+            raise ValueError(f"Invalid snapshot name {name}")
+        session = self.acquire(id)
+        try:
+            with open(self.snapshot_path(name), "wb") as f:
+                pickle.dump(
+                    {
+                        "model": session.model,
+                        "text": session.text,
+                        "messages": session.messages,
+                        "kv": session.kv,
+                    },
+                    f,
+                )
+        finally:
+            self.release(session)
+        self.evict()
+        return name
+
+    def restore(self, name: str) -> Session:
+        if not SNAPSHOT_NAME.match(name) or not self.snapshot_path(name).exists():
+            raise ValueError(f"Unknown snapshot {name}")
+        with open(self.snapshot_path(name), "rb") as f:
+            saved = pickle.load(f)
+        session = Session(
+            uuid.uuid4().hex,
+            saved["model"],
+            saved["text"],
+            saved["messages"],
+            saved["kv"],
+        )
+        with self.lock:
+            self.sessions[session.id] = session
+        self.evict()
+        return session
+
+    def status(self) -> list[dict]:
+        with self.lock:
+            return [session.status() for session in self.sessions.values()]
+
+    def kv_path(self, id: str):
+        return self.path / f"{id}.kv"
+
+    def snapshot_path(self, name: str):
+        return self.path / f"{name}.session"
@@ -1,19 +1,41 @@
 import asyncio
 import websockets
 
+from engines.engine import CancellationToken
 from request import IResponder, Request, Response
 from websockets.asyncio.server import ServerConnection, serve
 from websockets.protocol import State
 from models import ModelManager
+from scheduler import Priority
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Clients pick the encoding with the websocket subprotocol. Without one,
+# requests and responses are JSON in text frames
+JSON_PROTOCOL = "ullm.json"
+MSGPACK_PROTOCOL = "ullm.msgpack"
 
 
 class SocketResponder(IResponder):
-    def __init__(self, websocket: ServerConnection):
+    def __init__(self, websocket: ServerConnection, model_manager: ModelManager):
+        super().__init__(model_manager)
         self.websocket = websocket
+        self.client = f"ws:{websocket.remote_address}"
+        self.priority = Priority.INTERACTIVE
+        # MessagePack in binary frames, negotiated at the handshake
+        self.binary = websocket.subprotocol == MSGPACK_PROTOCOL
 
     async def raw_response(self, response: Response):
         if self.websocket.state == State.OPEN:
-            await self.websocket.send("\n" + response.toJSON())
+            if self.binary:
+                await self.websocket.send(msgpack.packb(response.to_dict()))
+            else:
+                await self.websocket.send("\n" + response.toJSON())
+        else:
+            self.disconnected()
 
     async def response(self, response: Response):
         await self.raw_response(response)
@@ -22,31 +44,138 @@ class SocketResponder(IResponder):
         await self.raw_response(response)
 
 
-async def handler(websocket: ServerConnection, model_manager: ModelManager):
-    responder = SocketResponder(websocket)
+def decode(message: str | bytes) -> Request:
+    # Binary frames carry MessagePack, whatever the connection negotiated
+    if isinstance(message, bytes):
+        if msgpack is None:
+            raise ValueError("Binary frames need msgpack installed on the server")
+        data = msgpack.unpackb(message)
+        if not isinstance(data, dict):
+            raise ValueError("Requests must be maps")
+        return Request(**data)
+    return Request.from_json(message)
+
+
+# Answered right away, whatever else the connection has in flight
+CONTROL_METHODS = ("cancel", "ping", "status", "metrics", "list_models")
+
+
+async def handler(
+    websocket: ServerConnection, model_manager: ModelManager, max_in_flight: int
+):
+    # Every request runs as its own task and responses carry its id, so one
+    # connection can interleave many streams. Past `max_in_flight` running
+    # requests new ones are parked in order, the connection keeps reading so
+    # control methods still get through
+    responder = SocketResponder(websocket, model_manager)
+    loop = asyncio.get_running_loop()
+    in_flight: dict[str, asyncio.Task] = {}
+    parked: list[tuple[Request, CancellationToken]] = []
+    tasks: set[asyncio.Task] = set()
+    running = 0
+
+    async def serve_request(request: Request, slot: bool):
+        nonlocal running
+        try:
+            await request.handle(model_manager, responder)
+        except Exception as e:
+            await Response.new_no_id_error(str(e)).send(responder)
+        finally:
+            if slot:
+                running -= 1
+                in_flight.pop(request.id, None)  # type: ignore
+                drain()
+
+    def spawn(coroutine):
+        task = asyncio.create_task(coroutine)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    def drain():
+        nonlocal running
+        for entry in [entry for entry in parked if entry[1].cancelled]:
+            parked.remove(entry)
+            model_manager.cancellations.unregister(entry[1])
+            spawn(
+                Response.new_result(
+                    entry[0].id, {"status": "cancelled", "tokens": ""}
+                ).send(responder)
+            )
+        while parked and running < max_in_flight:
+            request, token = parked.pop(0)
+            model_manager.cancellations.unregister(token)
+            running += 1
+            in_flight[request.id] = spawn(serve_request(request, True))  # type: ignore
+
     try:
         async for message in websocket:
             try:
-                request = Request.from_json(message)
-                await request.handle(model_manager, responder)
+                request = decode(message)
             except Exception as e:
                 await Response.new_no_id_error(str(e)).send(responder)
+                continue
+            if request.method in CONTROL_METHODS:
+                spawn(serve_request(request, False))
+                continue
+            if request.id in in_flight or any(
+                request.id == entry[0].id for entry in parked
+            ):
+                # Cancel couldn't tell them apart
+                await Response.new_error(
+                    request.id, "A request with this id is already running"
+                ).send(responder)
+                continue
+            # Parked requests can be cancelled before they start
+            token = model_manager.cancellations.register(
+                request.id, responder.client, responder  # type: ignore
+            )
+            token.on_cancel(lambda: loop.call_soon_threadsafe(drain))
+            parked.append((request, token))
+            drain()
     except websockets.exceptions.ConnectionClosedError:
         pass
+    finally:
+        for _, token in parked:
+            model_manager.cancellations.unregister(token)
+        parked.clear()
+        responder.disconnected()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
-def start(host: str, port: int, model_manager: ModelManager):
+def start(
+    host: str, port: int, model_manager: ModelManager, max_in_flight: int = 64
+):
     import threading
 
-    thread = threading.Thread(target=task, args=(host, port, model_manager))
+    thread = threading.Thread(
+        target=task, args=(host, port, model_manager, max_in_flight)
+    )
     thread.start()
 
 
-def task(host: str, port: int, model_manager: ModelManager):
-    return asyncio.run(run(host, port, model_manager))
+def task(
+    host: str, port: int, model_manager: ModelManager, max_in_flight: int = 64
+):
+    return asyncio.run(run(host, port, model_manager, max_in_flight))
+
+
+def select_subprotocol(websocket: ServerConnection, offered) -> str | None:
+    # Clients that offer none, or none we know, get JSON
+    protocols = [JSON_PROTOCOL]
+    if msgpack is not None:
+        protocols.append(MSGPACK_PROTOCOL)
+    return next((protocol for protocol in offered if protocol in protocols), None)
 
 
-async def run(host: str, port: int, model_manager: ModelManager):
+async def run(
+    host: str, port: int, model_manager: ModelManager, max_in_flight: int = 64
+):
     print(f"Starting sockets server on {host}:{port}")
-    server = await serve(lambda ws: handler(ws, model_manager), host, port)
+    server = await serve(
+        lambda ws: handler(ws, model_manager, max_in_flight),
+        host,
+        port,
+        select_subprotocol=select_subprotocol,
+    )
     await server.serve_forever()
@@ -0,0 +1,117 @@
+from dataclasses import replace
+
+from engines.chat import render_chat
+from engines.engine import Engine, EngineParameters
+
+# What happens to a prompt that, with `max_tokens`, doesn't fit the window:
+# - error: the request fails
+# - oldest: the oldest turns after the system prompt are dropped, or the
+#   start of a plain prompt
+# - max_tokens: fewer tokens are generated
+# - shift: generation slides the window over the cache once it's full,
+#   keeping the system prompt
+STRATEGIES = ("error", "oldest", "max_tokens", "shift")
+
+
+def fit_prompt(
+    engine: Engine,
+    parameters: EngineParameters,
+    prompt: str | None = None,
+    messages: list[dict] | None = None,
+    strategy: str = "error",
+) -> tuple[str, EngineParameters, dict]:
+    # Returns the prompt to run, the parameters to run it with and what had
+    # to give way, counting tokens with the engine's own tokenizer
+    if strategy not in STRATEGIES:
+        raise ValueError(
+            f"Unknown truncation `{strategy}`, expected one of {', '.join(STRATEGIES)}"
+        )
+    template = engine.chat_template() if messages is not None else None
+    if messages is not None:
+        prompt = render_chat(messages, template)
+    if prompt is None:
+        raise ValueError("No `prompt` or `messages` provided")
+    window = engine.context_limit(parameters)
+    max_tokens = parameters.max_tokens or 0
+    tokens = engine.count_tokens(prompt)
+    if strategy == "shift":
+        keep = 0
+        if messages is not None:
+            system = leading_system(messages)
+            if system:
+                keep = engine.count_tokens(
+                    render_chat(messages[:system], template)
+                ) - engine.count_tokens(render_chat([], template))
+        return prompt, replace(parameters, context_shift=True, keep_tokens=keep), {}
+    if tokens + max_tokens <= window:
+        return prompt, parameters, {}
+    if strategy == "max_tokens" and tokens < window:
+        return (
+            prompt,
+            replace(parameters, max_tokens=window - tokens),
+            {"max_tokens": window - tokens},
+        )
+    if strategy == "oldest" and messages is not None:
+        kept = drop_oldest_turns(engine, messages, template, window - max_tokens)
+        if kept is not None:
+            return (
+                render_chat(kept, template),
+                parameters,
+                {"dropped_messages": len(messages) - len(kept)},
+            )
+    elif strategy == "oldest" and window > max_tokens:
+        cut = drop_oldest_text(engine, prompt, window - max_tokens)
+        return prompt[cut:], parameters, {"dropped_characters": cut}
+    raise ValueError(
+        f"Prompt of {tokens} tokens plus {max_tokens} new tokens doesn't fit in {window} tokens of context"
+    )
+
+
+def leading_system(messages: list[dict]) -> int:
+    count = 0
+    while count < len(messages) and messages[count].get("role") == "system":
+        count += 1
+    return count
+
+
+def drop_oldest_turns(
+    engine: Engine, messages: list[dict], template: str | None, budget: int
+) -> list[dict] | None:
+    # Keeps the system prompt and the most recent turns that fit, the last
+    # message is never dropped
+    system = leading_system(messages)
+
+    def kept(dropped: int) -> list[dict]:
+        return messages[:system] + messages[system + dropped :]
+
+    def fits(dropped: int) -> bool:
+        return engine.count_tokens(render_chat(kept(dropped), template)) <= budget
+
+    low, high = 0, len(messages) - system - 1
+    if high < 0 or not fits(high):
+        return None
+    while low < high:
+        middle = (low + high) // 2
+        if fits(middle):
+            high = middle
+        else:
+            low = middle + 1
+    # Templates that insist on alternating turns want a user turn first
+    while (
+        system + low < len(messages) - 1
+        and messages[system + low].get("role") == "assistant"
+    ):
+        low += 1
+    return kept(low)
+
+
+def drop_oldest_text(engine: Engine, prompt: str, budget: int) -> int:
+    # The fewest leading characters to cut for the rest to fit
+    low, high = 0, len(prompt)
+    while low < high:
+        middle = (low + high) // 2
+        if engine.count_tokens(prompt[middle:]) <= budget:
+            high = middle
+        else:
+            low = middle + 1
+    return low